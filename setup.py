@@ -66,6 +66,10 @@ setup(
         # eg:
         #   'rst': ['docutils>=0.11'],
         #   ':python_version=="2.6"': ['argparse'],
+        ':python_version=="2.7"': ['futures', 'scandir'],
+        'watch': ['inotify_simple'],
+        'server': ['waitress'],
+        'formats': ['mutagen>=1.29'],
     },
     entry_points={
         'console_scripts': [
@@ -0,0 +1,144 @@
+"""
+Benchmark of library processing phases on generated tree of MP3 files.
+
+Generated files have ID3v2.4 tag followed by few frames of silence. File names of given part of them
+match MATCHING_PATTERN, the rest is named so no pattern matches.
+"""
+import os
+import sys
+import random
+import collections
+from timeit import default_timer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from abp.core import (get_folder_dirs, walk_folders, get_id3_values, get_id3_changes, apply_changes, get_renames,
+                      apply_renames, PatternSet, TAG_PADDING)
+
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz frame of silence
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+MP3_FRAMES = 40
+MATCHING_PATTERN = r'(?P<album>[^/]+)/(?P<track_num>[0-9]+) (?P<artist>[^/]+) - (?P<title>[^/]+)\.mp3$'
+RENAME_PATTERN = '$artist/$album/$track_num $title.mp3'
+
+
+def _syncsafe_bytes(value):
+    return bytearray([(value >> shift) & 0x7f for shift in (21, 14, 7, 0)])
+
+
+def render_id3_tag(tags, padding=TAG_PADDING):
+    """
+    Input: {tag: value} with ID3_TAGS keys
+    Output: ID3v2.4 tag with utf8 text frames
+    """
+    frame_ids = {'track_num': b'TRCK', 'title': b'TIT2', 'artist': b'TPE1', 'album': b'TALB'}
+    frames = bytearray()
+    for tag, value in sorted(tags.items()):
+        data = b'\x03' + value.encode('utf8')
+        frames += frame_ids[tag] + _syncsafe_bytes(len(data)) + b'\x00\x00' + data
+    return bytes(b'ID3\x04\x00\x00' + _syncsafe_bytes(len(frames) + padding) + frames + b'\x00' * padding)
+
+
+def generate_library(path, folders=100, files_per_folder=10, depth=2, matching=0.8, seed=0):
+    """
+    Creates `folders` album directories, nested `depth` levels deep, each with `files_per_folder` files.
+    Tags of matching files differ from values in their names, so each of them has changes.
+
+    Returns number of created files.
+    """
+    rand = random.Random(seed)
+    audio = MP3_FRAME * MP3_FRAMES
+    count = 0
+
+    for i in range(folders):
+        parents = ['level %d-%d' % (level, i % (level + 2)) for level in range(depth - 1)]
+        folder_path = os.path.join(path, *(parents + ['album %d' % i]))
+        os.makedirs(folder_path)
+
+        for j in range(files_per_folder):
+            if rand.random() < matching:
+                file_name = '%02d artist %d - title %d.mp3' % (j + 1, i, j)
+            else:
+                file_name = 'track %d of album %d.mp3' % (j + 1, i)
+            tags = {'track_num': u'%d' % (j + 1), 'title': u'old title %d' % j,
+                    'artist': u'old artist %d' % i, 'album': u'old album %d' % i}
+            with open(os.path.join(folder_path, file_name), 'wb') as fp:
+                fp.write(render_id3_tag(tags))
+                fp.write(audio)
+            count += 1
+    return count
+
+
+def process_peak_rss():
+    """
+    Returns peak resident set size of current process in bytes, or None when it can't be measured.
+    It's the peak of whole process lifetime so far, not of last phase: phase which needs less memory than
+    any earlier one shows the same value.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class BenchmarkResult(collections.namedtuple('BenchmarkResult', 'phase files seconds process_peak_rss')):
+    @property
+    def files_per_second(self):
+        return self.files / self.seconds if self.seconds else float('inf')
+
+
+def run_benchmark(library_path, output_path, executor=None):
+    """
+    Runs phases one after another on library created by generate_library, so tags are changed
+    and files are renamed to output_path, like id3 and rename commands would do.
+
+    Output: [BenchmarkResult]
+    """
+    results = []
+    file_paths = [os.path.join(dir_path, file_name)
+                  for dir_path, files in walk_folders(library_path, stat=False)
+                  for file_name, _ in files]
+
+    def timed(phase, func):
+        started = default_timer()
+        files, value = func()
+        results.append(BenchmarkResult(phase, files, default_timer() - started, process_peak_rss()))
+        return value
+
+    def scan():
+        return len(file_paths), list(get_folder_dirs(library_path))
+
+    def read():
+        for file_path in file_paths:
+            get_id3_values(file_path)
+        return len(file_paths), None
+
+    def changes():
+        all_changes, ignored_files = get_id3_changes(
+            library_path, empty_override=False, file_patterns=PatternSet([MATCHING_PATTERN]),
+            asciify=False, unescape=False, executor=executor
+        )
+        return sum(len(rows) for _, rows in all_changes) + sum(len(rows) for _, rows in ignored_files), all_changes
+
+    def apply():
+        changed_files = apply_changes(all_changes, 'utf8', executor=executor)
+        return len(changed_files), None
+
+    def renames():
+        all_renames = get_renames(library_path, RENAME_PATTERN, executor=executor)
+        return sum(len(rows) for _, rows in all_renames), all_renames
+
+    def apply_rename():
+        return len(apply_renames(all_renames, library_path, output_path)), None
+
+    timed('get_folder_dirs', scan)
+    timed('get_id3_values', read)
+    all_changes = timed('get_id3_changes', changes)
+    timed('apply_changes', apply)
+    all_renames = timed('get_renames', renames)
+    timed('apply_renames', apply_rename)
+    return results
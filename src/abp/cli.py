@@ -5,16 +5,45 @@
 
 import os
 import re
+import csv
 import six
+import json
+import time
+import shutil
+import tempfile
+import itertools
+import contextlib
+import collections
 
 import click
-from tabletext import to_text
 
 from abp.core import (get_folder_dirs, get_folder_matched_files, get_id3_values, get_id3_changes, get_id3_values_dict,
-                      get_renames, apply_renames)
+                      iter_id3_changes, get_renames, iter_renames, apply_renames, match_rename_folders, apply_changes,
+                      id3_list, iter_id3_list, get_executor, EXECUTORS, parse_timestamp, read_checkpoint,
+                      write_checkpoint, TAG_PADDING, ID3_TAGS, TEXT_CACHE_SIZE, cached_asciify, cached_unescape)
+from abp.index import open_index
+from abp.journal import (JOURNAL_FILE_NAME, ID3, RENAME, JournalError, open_journal, interrupted_run, undoable_run,
+                         resume_changes, resume_renames, undo_run)
+from abp import stats
 
 
 TABLE_HEADERS = ['Track number', 'Title', 'Artist', 'Album']
+OUTPUT_FORMATS = ['table', 'ndjson', 'csv']
+# Streamed table columns widths, other columns get --column-width
+COLUMN_WIDTH = 20
+COLUMN_WIDTHS = {'track_num': 9, 'old_track_num': 13, 'status': 7}
+LIST_COLUMNS = ['dir', 'file'] + ID3_TAGS + ['error']
+CHANGES_COLUMNS = ['dir', 'file', 'status'] + ID3_TAGS + ['old_' + tag for tag in ID3_TAGS] + ['reason']
+RENAMES_COLUMNS = ['old_file_path', 'new_file_path', 'error']
+
+
+def to_text(*args, **kwargs):
+    """
+    tabletext is imported only when table is printed, so e.g. --help and ui start faster.
+    """
+    from tabletext import to_text
+    return to_text(*args, **kwargs)
+
 
 def validate_regex_list(ctx, param, values):
     output = []
@@ -25,6 +54,34 @@ def validate_regex_list(ctx, param, values):
             raise click.BadParameter('"%s" is not proper regex pattern - %s' % (value, str(e)))
     return output
 
+
+def validate_since(ctx, param, value):
+    """
+    Output: (timestamp, checkpoint_path)
+    """
+    if value is None:
+        return None, None
+    if not os.path.exists(value):
+        try:
+            return parse_timestamp(value), None
+        except ValueError:
+            pass
+    if not os.path.isdir(os.path.dirname(os.path.abspath(value))):
+        raise click.BadParameter('"%s" is neither time nor checkpoint file path' % value)
+    try:
+        return read_checkpoint(value), value
+    except (IOError, ValueError) as e:
+        raise click.BadParameter('"%s" is not proper checkpoint file - %s' % (value, str(e)))
+
+
+def since_option(func):
+    return click.option('--since', callback=validate_since, metavar='TIME|CHECKPOINT',
+                        help='Process only files modified after given time (timestamp or YYYY-MM-DD[THH:MM:SS]) '
+                             'or after time stored in checkpoint file. Checkpoint file is created or updated '
+                             'with start time of run once all found changes are applied. Files written by run are '
+                             'stored in it too, so next run processes them only when they are changed again.')(func)
+
+
 def tabulate_ignored_files(table):
     """
     Input: [dir_path, [file, reason]]
@@ -110,29 +167,265 @@ def tabulate_changes(table):
 
 
 def tabulate_renames(table):
-    pass
+    """
+    Input: [dir_path, [(new_file_path, old_file_path)]]
+    """
+    rows = [
+        [dir_path, old_file_path, new_file_path] if i == 0 else ['', old_file_path, new_file_path]
+        for dir_path, files in table
+        for i, (new_file_path, old_file_path) in enumerate(files)
+    ]
+    return to_text([['Directory path', 'Old file path', 'New file path']] + rows, header=True)
+
+
+def _fit_cell(cell, width):
+    text = u'' if cell is None else six.text_type(cell).replace(u'\n', u' ')
+    if len(text) > width:
+        text = text[:width - 1] + u'…'
+    return text.ljust(width)
+
+
+def iter_table_lines(rows, columns, column_width=COLUMN_WIDTH):
+    """
+    Table rendered row by row, so columns widths are declared upfront instead of measured.
+    Longer cells are truncated.
+    """
+    widths = [COLUMN_WIDTHS.get(column, column_width) for column in columns]
+
+    def border(left, middle, right, line):
+        return left + middle.join(line * (width + 2) for width in widths) + right
+
+    def row_line(cells):
+        return u'│ ' + u' │ '.join(_fit_cell(cell, width) for cell, width in zip(cells, widths)) + u' │'
+
+    yield border(u'╒', u'╤', u'╕', u'═')
+    yield row_line(columns)
+    yield border(u'╞', u'╪', u'╡', u'═')
+    for row in rows:
+        yield row_line(row)
+    yield border(u'└', u'┴', u'┘', u'─')
+
+
+class _EchoStream(object):
+    def write(self, data):
+        click.echo(data, nl=False)
+
+
+def echo_records(rows, columns, output_format='table', column_width=COLUMN_WIDTH):
+    """
+    Rows (cells in columns order) are written one by one as soon as they are yielded,
+    as JSON object per line, CSV or table with fixed columns widths.
+    """
+    if output_format == 'ndjson':
+        for row in rows:
+            click.echo(json.dumps(collections.OrderedDict(zip(columns, row)), ensure_ascii=False))
+    elif output_format == 'csv':
+        writer = csv.writer(_EchoStream(), lineterminator='\n')
+        writer.writerow(columns)
+        for row in rows:
+            if six.PY2:
+                row = [cell.encode('utf8') if isinstance(cell, six.text_type) else cell for cell in row]
+            writer.writerow(row)
+    else:
+        for line in iter_table_lines(rows, columns, column_width):
+            click.echo(line)
+
+
+def format_options(func):
+    func = click.option('--column-width', default=COLUMN_WIDTH, type=click.IntRange(4, None), show_default=True,
+                        help='Width of columns of streamed table, longer values are truncated.')(func)
+    func = click.option('--format', 'output_format', type=click.Choice(OUTPUT_FORMATS), default='table',
+                        show_default=True,
+                        help='Output format. ndjson (JSON object per line) and csv are streamed, one record per file.')(func)
+    return func
+
+
+def jobs_options(func):
+    func = click.option('--executor', type=click.Choice(sorted(EXECUTORS)), default='thread',
+                        help='Executor used when jobs > 1. Default thread.')(func)
+    func = click.option('--jobs', '-j', default=1, type=click.IntRange(1, None),
+                        help='Number of files processed in parallel.')(func)
+    return func
+
+
+def index_option(func):
+    return click.option('--index/--no-index', default=True,
+                        help='Use tag index stored in cache directory (ABP_CACHE_DIR, ~/.cache/abp by default). '
+                             'Default enabled.')(func)
+
+
+@contextlib.contextmanager
+def library_index(input_path, enabled=True):
+    index = open_index(input_path) if enabled else None
+    try:
+        yield index
+    finally:
+        if index is not None:
+            index.close()
+
+
+def journal_options(func):
+    func = click.option('--resume', is_flag=True,
+                        help='Continue interrupted run from journal, library is not scanned again.')(func)
+    func = click.option('--journal/--no-journal', default=True,
+                        help='Record applied changes in journal stored in library root (%s), so interrupted run '
+                             'can be resumed and changes undone with abp undo. Default enabled.' % JOURNAL_FILE_NAME)(func)
+    return func
+
+
+@contextlib.contextmanager
+def library_journal(input_path, enabled=True, required=False):
+    """
+    Required journal is only opened when it exists, so --resume or undo doesn't create empty one.
+    """
+    if required and not os.path.exists(os.path.join(input_path, JOURNAL_FILE_NAME)):
+        raise click.ClickException('There is no journal %s in %s' % (JOURNAL_FILE_NAME, input_path))
+    journal = open_journal(input_path) if enabled or required else None
+    if journal is None and required:
+        raise click.ClickException('Journal can\'t be opened in %s' % input_path)
+    try:
+        yield journal
+    finally:
+        if journal is not None:
+            journal.close()
+
+
+def begin_journal_run(journal, kind, **params):
+    """
+    Run begins only once, right before first file is changed, so cancelled or empty runs aren't recorded.
+    """
+    if journal is not None and journal.run is None:
+        journal.begin(kind, **params)
+
+
+def end_journal_run(journal):
+    if journal is not None and journal.run is not None:
+        journal.end()
+
+
+def get_journal_run(func, *args):
+    try:
+        return func(*args)
+    except JournalError as e:
+        raise click.ClickException(str(e))
+
+
+def tabulate_stats(report):
+    rows = [
+        [phase, str(histogram['count']), '%.3f' % histogram['total'], '%.3f' % (histogram['mean'] * 1000),
+         '%.3f' % (histogram['max'] * 1000)]
+        for phase, histogram in sorted(report['phases'].items())
+    ]
+    output = [to_text([['Phase', 'Count', 'Total s', 'Mean ms', 'Max ms']] + rows, header=True)]
+    if report['counters']:
+        output.append(to_text([['Counter', 'Value']] +
+                              [[name, str(value)] for name, value in sorted(report['counters'].items())],
+                              header=True))
+    slowest = sorted(
+        ((seconds, phase, item) for phase, histogram in report['phases'].items()
+         for item, seconds in histogram['slowest']),
+        reverse=True
+    )[:stats.SLOWEST_ITEMS]
+    if slowest:
+        output.append(to_text([['Slowest', 'Phase', 'ms']] +
+                              [[item, phase, '%.3f' % (seconds * 1000)] for seconds, phase, item in slowest],
+                              header=True))
+    return '\n'.join(output)
+
+
+def write_stats(profile, stats_json):
+    report = stats.report()
+    stats.disable()
+    if stats_json:
+        with open(stats_json, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    if profile:
+        click.echo(tabulate_stats(report), err=True)
 
 
 @click.group()
-def cli():
-    pass
+@click.option('--profile', is_flag=True,
+              help='Print time spent in each phase, counters and slowest files when command ends. '
+                   'Work done in process executor workers is not recorded.')
+@click.option('--stats-json', type=click.Path(dir_okay=False, writable=True),
+              help='Write the same statistics as JSON to given file.')
+@click.pass_context
+def cli(ctx, profile, stats_json):
+    if profile or stats_json:
+        stats.enable()
+        ctx.call_on_close(lambda: write_stats(profile, stats_json))
+
+
+def iter_list_rows(folders):
+    for folder in folders:
+        for file_ in folder['files']:
+            yield [folder['dir'], file_['file']] + list(file_['id3']) + [file_.get('error')]
+
+
+def iter_changes_rows(changes):
+    empty_values = [''] * len(ID3_TAGS)
+    for dir_path, path_changes, path_ignored_files in changes:
+        rows = [[dir_path, file_name, 'change'] + list(new_values) + list(old_values) + [None]
+                for file_name, new_values, old_values in path_changes]
+        rows.extend([dir_path, file_name, 'ignored'] + empty_values + empty_values + [reason]
+                    for file_name, reason in path_ignored_files)
+        for row in sorted(rows, key=lambda row: row[1]):
+            yield row
+
+
+def iter_renames_rows(renames, input_path, errors):
+    """
+    errors list is filled by iter_renames, its rows are yielded as soon as they appear.
+    """
+    def error_rows():
+        while errors:
+            dir_path, file_name, error = errors.pop(0)
+            yield [os.path.relpath(os.path.join(dir_path, file_name), input_path), None, error]
+
+    for dir_path, rows in renames:
+        for row in error_rows():
+            yield row
+        for new_file_path, old_file_path in rows:
+            yield [old_file_path, new_file_path, None]
+    for row in error_rows():
+        yield row
 
 
 @cli.command(name='list')
 @click.argument('input', default='.', type=click.Path(exists=True, dir_okay=True, readable=True))
+@click.option('--stream', '-s', is_flag=True,
+              help='Print table rows as soon as directory is read, with fixed columns widths.')
+@format_options
+@jobs_options
+@index_option
 def list_(**kwargs):
     input_path = kwargs['input']
     values = []
-    for row in id3_list(input_path):
-        dir_path = row['dir']
-        path_values = []
-        for file_ in row['files']:
-            path_values.append((file_['file'], file_['id3']))
-        values.append((dir_path, path_values))
+    read_errors = []
+    with get_executor(kwargs['jobs'], kwargs['executor']) as executor, library_index(input_path, kwargs['index']) as index:
+        if kwargs['stream'] or kwargs['output_format'] != 'table':
+            echo_records(iter_list_rows(iter_id3_list(input_path, executor=executor, index=index)), LIST_COLUMNS,
+                         kwargs['output_format'], kwargs['column_width'])
+            return
+
+        for row in id3_list(input_path, executor=executor, index=index):
+            dir_path = row['dir']
+            path_values = []
+            path_errors = []
+            for file_ in row['files']:
+                path_values.append((file_['file'], file_['id3']))
+                if 'error' in file_:
+                    path_errors.append((file_['file'], file_['error']))
+            values.append((dir_path, path_values))
+            if path_errors:
+                read_errors.append((dir_path, path_errors))
 
     click.echo(tabulate_values(values))
     click.echo('\n')
 
+    if read_errors:
+        click.echo('\n%s\n%s\n' % ('READ ERRORS', tabulate_ignored_files(read_errors)))
+
 
 def get_grouped_commands(groups=[], first_group_name='Options'):
     groups = iter(groups)
@@ -181,10 +474,27 @@ def get_grouped_commands(groups=[], first_group_name='Options'):
               help='All changes confirmation.')
 @click.option('--no-confirmation', '-f', is_flag=True,
               help='No confirmation needed')
+@click.option('--stream', '-s', is_flag=True,
+              help='Confirm and apply changes directory by directory, as soon as they are read. '
+                   'Journal plans each directory right before applying it, so --resume continues only '
+                   'directories reached before interruption.')
 @click.option('--empty-override', '-o', is_flag=True,
               help='If regex pattern doesn\'t define tag clear it anyway.')
 @click.option('--encoding', '-e', default='utf8',
               help='Save ID3 tags with given encoding. Available utf8, latin1')
+@click.option('--padding', default=TAG_PADDING, type=click.IntRange(min=0), show_default=True,
+              help='Bytes of padding reserved when new tag doesn\'t fit in current one and whole file is rewritten, ' +
+              'so later edits are written in place.')
+@click.option('--text-cache-size', default=TEXT_CACHE_SIZE, type=click.IntRange(min=1), show_default=True,
+              help='Number of distinct texts which asciify and unescape results are cached for. '
+                   'Hit rates are shown with abp --profile.')
+@click.option('--dry-run', '-n', is_flag=True,
+              help='Only print changes, one record per file as soon as it\'s computed. Nothing is applied.')
+@format_options
+@journal_options
+@since_option
+@jobs_options
+@index_option
 def id3(**kwargs):
     input_path = kwargs['input']
     asciify = kwargs['asciify']
@@ -196,31 +506,141 @@ def id3(**kwargs):
     no_confirmation = kwargs['no_confirmation']
     confirm_all = kwargs['confirm_all']
     confirm_each_directory = kwargs['confirm_each_directory']
+    padding = kwargs['padding']
+    since, checkpoint_path = kwargs['since']
+    started = time.time()
+    rewritten = []
+    cached_asciify.maxsize = cached_unescape.maxsize = kwargs['text_cache_size']
+
+    if kwargs['stream'] and confirm_all:
+        raise click.UsageError('--confirm-all needs all changes upfront, so it can\'t be used with --stream.')
+
+    if kwargs['resume']:
+        with library_journal(input_path, required=True) as journal, library_index(input_path, kwargs['index']) as index, \
+                get_executor(kwargs['jobs'], kwargs['executor']) as executor:
+            run = get_journal_run(interrupted_run, journal, ID3)
+            click.echo('RESUMING %d of %d change(s)' % (len(run.pending()), len(run.planned)))
+            resume_changes(journal, run, index=index, executor=executor, rewritten=rewritten)
+        if rewritten:
+            click.echo('\n%d file(s) needed full rewrite, as new tag didn\'t fit in current padding' % len(rewritten))
+        return
+
+    with library_index(input_path, kwargs['index']) as index, \
+            library_journal(input_path, kwargs['journal'] and not kwargs['dry_run']) as journal, \
+            get_executor(kwargs['jobs'], kwargs['executor']) as executor:
+        if kwargs['dry_run']:
+            changes = iter_id3_changes(
+                input_path,
+                empty_override=empty_override, file_patterns=file_patterns, asciify=asciify,
+                unescape=unescape, executor=executor, index=index, since=since
+            )
+            echo_records(iter_changes_rows(changes), CHANGES_COLUMNS, kwargs['output_format'], kwargs['column_width'])
+            return
+
+        journal_params = dict(encoding=encoding, padding=padding, empty_override=empty_override)
+        if kwargs['stream']:
+            changes = iter_id3_changes(
+                input_path,
+                empty_override=empty_override, file_patterns=file_patterns, asciify=asciify,
+                unescape=unescape, executor=executor, index=index, since=since
+            )
+            written_files, all_approved = apply_streamed_changes(
+                changes,
+                confirm_each_directory=confirm_each_directory,
+                no_confirmation=no_confirmation,
+                encoding=encoding, index=index, executor=executor, padding=padding, rewritten=rewritten,
+                empty_override=empty_override, journal=journal, journal_params=journal_params
+            )
+        else:
+            all_changes, ignored_files = get_id3_changes(
+                input_path,
+                empty_override=empty_override, file_patterns=file_patterns, asciify=asciify,
+                unescape=unescape, executor=executor, index=index, since=since
+            )
 
-    all_changes, ignored_files = get_id3_changes(
-        input_path,
-        empty_override=empty_override, file_patterns=file_patterns, asciify=asciify,
-        unescape=unescape
-    )
+            if ignored_files:
+                click.echo('\n%s\n%s\n' % ('IGNORED FILES', tabulate_ignored_files(ignored_files)))
 
-    if ignored_files:
-        click.echo('\n%s\n%s\n' % ('IGNORED FILES', tabulate_ignored_files(ignored_files)))
+            approved_changes = get_approved_changes(
+                all_changes,
+                confirm_each_directory=confirm_each_directory,
+                confirm_all=confirm_all,
+                no_confirmation=no_confirmation
+            )
 
-    approved_changes = get_approved_changes(
-        all_changes,
-        confirm_each_directory=confirm_each_directory,
-        confirm_all=confirm_all,
-        no_confirmation=no_confirmation
-    )
+            click.echo('\nAPPLYING CHANGES')
+            if any(rows for _, rows in approved_changes):
+                begin_journal_run(journal, ID3, **journal_params)
+            written_files = apply_changes(approved_changes, encoding=encoding, index=index, executor=executor,
+                                          padding=padding, rewritten=rewritten, empty_override=empty_override,
+                                          journal=journal)
+            all_approved = count_rows(approved_changes) == count_rows(all_changes)
 
-    click.echo('\nAPPLYING CHANGES')
-    apply_changes(approved_changes, encoding=encoding)
+        end_journal_run(journal)
+
+    if rewritten:
+        click.echo('\n%d file(s) needed full rewrite, as new tag didn\'t fit in current padding' % len(rewritten))
+    if checkpoint_path and all_approved:
+        write_checkpoint(checkpoint_path, started, written_files)
+
+
+def count_rows(records):
+    return sum(len(rows) for _, rows in records)
+
+
+def apply_streamed_changes(changes, confirm_each_directory, no_confirmation, encoding, index=None, executor=None,
+                           padding=TAG_PADDING, rewritten=None, empty_override=False, journal=None, journal_params=None):
+    """
+    Each directory changes are confirmed and applied as soon as they are yielded.
+    Journal run begins with first approved directory, its changes are planned directory by directory.
+
+    Returns (written_files[], all_approved), all_approved is False when any change was skipped.
+    """
+    written_files = []
+    all_approved = True
+    try:
+        for dir_path, path_changes, path_ignored_files in changes:
+            if path_ignored_files:
+                click.echo('\n%s\n%s\n' % ('IGNORED FILES', tabulate_ignored_files([(dir_path, path_ignored_files)])))
+            if not path_changes:
+                continue
+
+            click.echo('\nCHANGES')
+            approved = 0
+            for approved_record in iter_approved_changes([(dir_path, path_changes)], confirm_each_directory,
+                                                         no_confirmation):
+                begin_journal_run(journal, ID3, **(journal_params or {}))
+                written_files.extend(apply_changes([approved_record], encoding=encoding, index=index,
+                                                   executor=executor, padding=padding, rewritten=rewritten,
+                                                   empty_override=empty_override, journal=journal))
+                approved += len(approved_record[1])
+            all_approved = all_approved and approved == len(path_changes)
+    except SkipRestException:
+        all_approved = False
+    return written_files, all_approved
 
 
 class SkipRestException(Exception):
     pass
 
 
+def iter_approved_changes(changes, confirm_each_directory, no_confirmation):
+    """
+    Yields approved (dir_path, rows) records as soon as they are confirmed.
+    SkipRestException is raised when user skips all remaining changes.
+    """
+    for dir_path, rows in changes:
+        if no_confirmation or confirm_each_directory:
+            click.echo(tabulate_changes([(dir_path, rows)]))
+            if no_confirmation or changes_confirmation(text='Apply those changes?'):
+                yield dir_path, rows
+        else:
+            for row in rows:
+                click.echo(tabulate_changes([(dir_path, [row])]))
+                if changes_confirmation(text='Apply this change?'):
+                    yield dir_path, [row]
+
+
 def get_approved_changes(changes, confirm_each_directory, confirm_all, no_confirmation):
     click.echo('\nCHANGES')
     approved_changes = []
@@ -233,19 +653,9 @@ def get_approved_changes(changes, confirm_each_directory, confirm_all, no_confir
             click.echo(tabulate_changes(changes))
             if changes_confirmation(text='Apply those changes?'):
                 approved_changes.extend(changes)
-        elif confirm_each_directory:
-            for dir_path, rows in changes:
-                changes_record = [(dir_path, rows)]
-                click.echo(tabulate_changes(changes_record))
-                if changes_confirmation(text='Apply those changes?'):
-                    approved_changes.append(changes_record)
         else:
-            for dir_path, rows in changes:
-                for file_name, new_values, old_values in rows:
-                    changes_record = [(dir_path, [(file_name, new_values, old_values)])]
-                    click.echo(tabulate_changes(changes_record))
-                    if changes_confirmation(text='Apply this change?'):
-                        approved_changes.extend(changes_record)
+            for approved_record in iter_approved_changes(changes, confirm_each_directory, no_confirmation=False):
+                approved_changes.append(approved_record)
     except SkipRestException:
         pass
 
@@ -256,14 +666,23 @@ def get_approved_changes(changes, confirm_each_directory, confirm_all, no_confir
 @click.argument('input', default='.', type=click.Path(exists=True, dir_okay=True, readable=True))
 @click.option('--output', '-o', type=click.Path(dir_okay=True, readable=True),
               help='Output path. Not given means changes will be processed in the same directory.')
-@click.option('--file-path-pattern', '-p', required=True,
-              help='Pattern of file path. Available variables: $track_num, $title, $artist, $album.')
+@click.option('--file-path-pattern', '-p',
+              help='Pattern of file path. Available variables: $track_num, $title, $artist, $album, $ext (file extension).')
+@click.option('--only-matched', '-m', is_flag=True,
+              help='Rename only directories which all files have tags used in pattern and would be renamed.')
 @click.option('--confirm-each-directory', '-d', is_flag=True,
               help='Each directory changes confirmation.')
 @click.option('--confirm-all', '-a', is_flag=True,
               help='All changes confirmation.')
 @click.option('--no-confirmation', '-f', is_flag=True,
               help='No confirmation needed')
+@click.option('--dry-run', '-n', is_flag=True,
+              help='Only print renames, one record per file as soon as it\'s computed. Nothing is renamed.')
+@format_options
+@journal_options
+@since_option
+@jobs_options
+@index_option
 def rename(**kwargs):
     input_path = kwargs['input']
     output_path = kwargs['output'] or kwargs['input']
@@ -273,17 +692,142 @@ def rename(**kwargs):
     confirm_all = kwargs['confirm_all']
     confirm_each_directory = kwargs['confirm_each_directory']
 
-    renames = get_renames(input_path, file_path_pattern)
-    approved_renames = get_approved_renames(renames, confirm_each_directory, confirm_all, no_confirmation)
-    apply_renames(approved_renames, input_path, output_path)
+    since, checkpoint_path = kwargs['since']
+    started = time.time()
+
+    if kwargs['resume']:
+        with library_journal(input_path, required=True) as journal, library_index(input_path, kwargs['index']) as index, \
+                get_executor(kwargs['jobs'], kwargs['executor']) as executor:
+            run = get_journal_run(interrupted_run, journal, RENAME)
+            click.echo('RESUMING %d of %d rename(s)' % (len(run.pending()), len(run.planned)))
+            resume_renames(journal, run, index=index, executor=executor)
+        return
+    if not file_path_pattern:
+        raise click.UsageError('Missing option "--file-path-pattern" / "-p".')
+
+    read_errors = []
+    with library_index(input_path, kwargs['index']) as index, \
+            library_journal(input_path, kwargs['journal'] and not kwargs['dry_run']) as journal:
+        folder_dirs = None
+        if kwargs['only_matched']:
+            folder_dirs = list(match_rename_folders(input_path, file_path_pattern, index=index, since=since))
+        with get_executor(kwargs['jobs'], kwargs['executor']) as executor:
+            if kwargs['dry_run']:
+                renames = iter_renames(input_path, file_path_pattern, folder_dirs=folder_dirs, executor=executor,
+                                       errors=read_errors, index=index, since=since)
+                echo_records(iter_renames_rows(renames, input_path, read_errors), RENAMES_COLUMNS,
+                             kwargs['output_format'], kwargs['column_width'])
+                return
+
+            renames = get_renames(input_path, file_path_pattern, folder_dirs=folder_dirs, executor=executor,
+                                  errors=read_errors, index=index, since=since)
+
+            if read_errors:
+                errors_table = [(dir_path, [(file_name, error) for _, file_name, error in rows])
+                                for dir_path, rows in itertools.groupby(read_errors, key=lambda row: row[0])]
+                click.echo('\n%s\n%s\n' % ('READ ERRORS', tabulate_ignored_files(errors_table)))
+
+            approved_renames = get_approved_renames(renames, confirm_each_directory, confirm_all, no_confirmation)
+            if any(rows for _, rows in approved_renames):
+                begin_journal_run(journal, RENAME, input=os.path.abspath(input_path),
+                                  output=os.path.abspath(output_path))
+            written_files = apply_renames(approved_renames, input_path, output_path, index=index, executor=executor,
+                                          journal=journal)
+            all_approved = count_rows(approved_renames) == count_rows(renames)
+            end_journal_run(journal)
+
+    if checkpoint_path and all_approved:
+        write_checkpoint(checkpoint_path, started, written_files)
+
+
+@cli.command()
+@click.argument('input', default='.', type=click.Path(exists=True, dir_okay=True, readable=True))
+@click.option('--no-confirmation', '-f', is_flag=True,
+              help='No confirmation needed')
+@jobs_options
+@index_option
+def undo(**kwargs):
+    """
+    Rolls back last id3 or rename run recorded in library journal, also interrupted one.
+    Run again to undo previous one.
+    """
+    input_path = kwargs['input']
+    errors = []
+    with library_journal(input_path, required=True) as journal, library_index(input_path, kwargs['index']) as index, \
+            get_executor(kwargs['jobs'], kwargs['executor']) as executor:
+        run = get_journal_run(undoable_run, journal)
+        if run.kind == ID3:
+            records = run.completed()
+            click.echo(tabulate_changes([
+                (dir_path, [(os.path.basename(record['file']), record['old'], record['new']) for record in rows])
+                for dir_path, rows in itertools.groupby(records, key=lambda record: os.path.dirname(record['file']))
+            ]))
+        else:
+            records = list(run.planned.values())
+            click.echo(tabulate_renames([('', [(record['old'], record['new']) for record in records])]))
+
+        if not kwargs['no_confirmation'] and not click.confirm('\nUndo %s of %d file(s)?' % (run.kind, len(records))):
+            return
+        undo_run(journal, run, index=index, executor=executor, errors=errors)
+
+    if errors:
+        click.echo('\n%s\n%s\n' % ('UNDO ERRORS', tabulate_ignored_files([('', errors)])))
 
 
 @cli.command()
 @click.argument('input', default='.', type=click.Path(exists=True, dir_okay=True, readable=True))
+@click.option('--host', default='127.0.0.1', show_default=True,
+              help='Address to listen on.')
+@click.option('--port', default=5000, type=click.IntRange(1, 65535), show_default=True,
+              help='Port to listen on.')
+@click.option('--threads', default=8, type=click.IntRange(1, None), show_default=True,
+              help='Number of threads serving requests. Used with waitress server (audio-batch-processor[server]).')
+@click.option('--debug', is_flag=True,
+              help='Run Flask development server with reloader and debugger.')
 def ui(**kwargs):
     from abp import ui
     app = ui.create_app(kwargs['input'])
-    app.run(debug=True)
+    if kwargs['debug']:
+        app.run(host=kwargs['host'], port=kwargs['port'], debug=True)
+    else:
+        ui.serve(app, host=kwargs['host'], port=kwargs['port'], threads=kwargs['threads'])
+
+
+@cli.command()
+@click.option('--folders', default=100, type=click.IntRange(1, None), show_default=True,
+              help='Number of generated album directories.')
+@click.option('--files', default=10, type=click.IntRange(1, None), show_default=True,
+              help='Number of files in each directory.')
+@click.option('--depth', default=2, type=click.IntRange(1, None), show_default=True,
+              help='Depth of directory tree.')
+@click.option('--matching', default=0.8, type=click.FloatRange(0, 1), show_default=True,
+              help='Part of files which names match benchmark pattern.')
+@click.option('--path', type=click.Path(exists=False, file_okay=False),
+              help='Directory where library is generated and kept. By default temporary one is removed afterwards.')
+@jobs_options
+def benchmark(**kwargs):
+    """
+    Times processing phases on generated library of MP3 files.
+    """
+    from abp.benchmark import generate_library, run_benchmark
+
+    root = kwargs['path'] or tempfile.mkdtemp(prefix='abp-benchmark-')
+    library_path = os.path.join(root, 'library')
+    try:
+        generate_library(library_path, kwargs['folders'], kwargs['files'], kwargs['depth'], kwargs['matching'])
+        with get_executor(kwargs['jobs'], kwargs['executor']) as executor:
+            results = run_benchmark(library_path, os.path.join(root, 'renamed'), executor=executor)
+    finally:
+        if not kwargs['path']:
+            shutil.rmtree(root)
+
+    rows = [
+        [result.phase, str(result.files), '%.3f' % result.seconds, '%.1f' % result.files_per_second,
+         '%.1f' % (result.process_peak_rss / 1024.0 / 1024.0) if result.process_peak_rss is not None else '-']
+        for result in results
+    ]
+    click.echo(to_text([['Phase', 'Files', 'Seconds', 'Files/sec', 'Process peak RSS (MB)']] + rows, header=True))
+    click.echo('Process peak RSS is the highest memory use since abp started, up to the end of each phase.')
 
 
 def get_approved_renames(renames, confirm_each_directory, confirm_all, no_confirmation):
@@ -303,7 +847,7 @@ def get_approved_renames(renames, confirm_each_directory, confirm_all, no_confir
                 renames_record = [(dir_path, rows)]
                 click.echo(tabulate_renames(renames_record))
                 if changes_confirmation(text='Apply those renames?'):
-                    approved_renames.append(renames_record)
+                    approved_renames.extend(renames_record)
         else:
             for dir_path, rows in renames:
                 for new_file_path, old_file_path in rows:
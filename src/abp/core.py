@@ -1,23 +1,48 @@
 import os
 import re
 import six
-import eyed3
-
-from unidecode import unidecode
+import json
+import time
+import datetime
+import itertools
+import threading
+import collections
+
+from concurrent import futures
+try:
+    from os import scandir
+except ImportError:  # Python < 3.5
+    from scandir import scandir
+from six.moves import zip
 from unicodedata import normalize
-from six.moves import html_parser
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
 
-html = html_parser.HTMLParser()
-eyed3.log.setLevel("ERROR")
+from abp.readers import TagReaderError, read_id3_tags, read_flac_tags, read_ogg_tags, read_mp4_tags, is_mp3_header
+from abp.moves import move_file
+from abp import stats
 
 
-AUDIO_FILE_PATTERN = re.compile(r'.+\.mp3$')
+AUDIO_FILE_PATTERN = re.compile(r'.+\.mp3$')  # extensions of registered backends, see register_backend
 ID3_TAGS = ['track_num', 'title', 'artist', 'album']
+# Padding reserved when whole file is rewritten, so later tag edits can be written in place.
+TAG_PADDING = 4096
+# Number of distinct texts kept by each of asciify and unescape caches
+TEXT_CACHE_SIZE = 10000
+# Bytes read to detect format by magic bytes
+MAGIC_SIZE = 12
+# Number of files which backend confirmed when they were read is kept for writing them, see recall_backend
+BACKEND_CACHE_SIZE = 10000
+VORBIS_COMMENT_NAMES = {'track_num': 'TRACKNUMBER', 'title': 'TITLE', 'artist': 'ARTIST', 'album': 'ALBUM'}
+MP4_ITEM_NAMES = {'track_num': 'trkn', 'title': u'\xa9nam', 'artist': u'\xa9ART', 'album': u'\xa9alb'}
 ID3_TAGS_DESERIALIZER = {
     'track_num': lambda id3_track_num: six.text_type(id3_track_num and id3_track_num[0] or '')
 }
 ID3_TAGS_SERIALIZER = {
-    'track_num': lambda id3_track_num: (int(id3_track_num), None)
+    'track_num': lambda id3_track_num: (int(id3_track_num) if id3_track_num else None, None)
 }
 
 
@@ -26,7 +51,7 @@ def default_deserializer(x):
 
 
 def default_serializer(x):
-    return unicode(x)
+    return six.text_type(x)
 
 
 def id3_deserialize(tag, value):
@@ -39,93 +64,824 @@ def id3_serialize(tag, value):
     return method(value)
 
 
-def get_id3_values(file_path):
-    audiofile = eyed3.load(file_path)
-    if audiofile.tag is None:
-        audiofile.initTag()
-    return [id3_deserialize(tag, getattr(audiofile.tag, tag)) for tag in ID3_TAGS]
+def get_id3_values(file_path, index=None, stat=None):
+    """
+    Reads only tag frames, full parse is used only for tags not supported by header-only reader, see read_raw_tags.
+    When index is given, file is read only if it is not indexed yet or has been changed.
+    """
+    if index is not None:
+        stat = stat or os.stat(file_path)
+        values = index.get(file_path, stat)
+        if values is None:
+            stats.incr('index_misses')
+            values = get_id3_values(file_path)
+            index.set(file_path, stat, values)
+        else:
+            stats.incr('index_hits')
+        return values
+
+    stats.incr('files_read')
+    with stats.timer('read', file_path):
+        tags = read_raw_tags(file_path)
+        return [id3_deserialize(tag, tags.get(tag)) for tag in ID3_TAGS]
+
+
+_eyed3 = None
+_padded_tag_class = None
+_unescape = None
+
+
+def load_eyed3():
+    """
+    eyeD3 is slow to import, so it's imported only once file is parsed or written by it.
+    """
+    global _eyed3
+    if _eyed3 is None:
+        import eyed3
+        import eyed3.id3
+        eyed3.log.setLevel("ERROR")
+        _eyed3 = eyed3
+    return _eyed3
+
+
+def unescape_html(text):
+    global _unescape
+    if _unescape is None:
+        try:
+            from html import unescape  # Python >= 3.4
+        except ImportError:
+            from six.moves import html_parser
+            unescape = html_parser.HTMLParser().unescape
+        _unescape = unescape
+    return _unescape(text)
+
+
+def asciify_text(text):
+    from unidecode import unidecode
+    return unidecode(text)
+
+
+class LRUCache(object):
+    """
+    Memoizes single argument function, keeping at most maxsize least recently used results.
+    Hits and misses are counted in stats as <name>_cache_hits and <name>_cache_misses.
+    """
+    def __init__(self, func, maxsize, name):
+        self.func = func
+        self.maxsize = maxsize
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, value):
+        with self._lock:
+            try:
+                result = self._cache.pop(value)
+            except KeyError:
+                pass
+            else:
+                self._cache[value] = result  # moved to the end, as most recently used
+                self.hits += 1
+                stats.incr(self.name + '_cache_hits')
+                return result
+
+        result = self.func(value)
+        with self._lock:
+            self._cache[value] = result
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+            self.misses += 1
+        stats.incr(self.name + '_cache_misses')
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+
+cached_unescape = LRUCache(unescape_html, TEXT_CACHE_SIZE, 'unescape')
+cached_asciify = LRUCache(asciify_text, TEXT_CACHE_SIZE, 'asciify')
+
+
+def normalize_text(text, asciify, unescape, folder_cache=None):
+    """
+    Album and artist usually repeat in whole directory, so results are kept in folder_cache dict when given,
+    which is used before shared LRU caches and needs no locking. It has to be used with same asciify and unescape.
+    """
+    if folder_cache is not None:
+        result = folder_cache.get(text)
+        if result is not None:
+            stats.incr('folder_cache_hits')
+            return result
+
+    result = text
+    if unescape:
+        result = cached_unescape(result)
+    if asciify:
+        result = cached_asciify(result)
+
+    if folder_cache is not None:
+        folder_cache[text] = result
+    return result
 
 
-def save_id3_values(file_path, values, empty_override=False, encoding='utf8'):
-    audiofile = eyed3.load(file_path)
+def read_eyed3_tags(file_path):
+    audiofile = load_eyed3().load(file_path)
     if audiofile.tag is None:
         audiofile.initTag()
+    return dict((tag, getattr(audiofile.tag, tag)) for tag in ID3_TAGS)
+
+
+def get_eyed3_id3_values(file_path):
+    tags = read_eyed3_tags(file_path)
+    return [id3_deserialize(tag, tags[tag]) for tag in ID3_TAGS]
+
+
+def load_mutagen(file_path):
+    """
+    mutagen (audio-batch-processor[formats]) is needed to write FLAC, Ogg and MP4 tags, or to read them
+    when header-only reader can't. It's imported only then.
+    """
+    try:
+        import mutagen
+    except ImportError:
+        raise RuntimeError('mutagen is needed to parse %s, install audio-batch-processor[formats]' % file_path)
+    audio = mutagen.File(file_path)
+    if audio is None:
+        raise TagReaderError('Unknown format of %s' % file_path)
+    if audio.tags is None:
+        audio.add_tags()
+    return audio
+
+
+def _is_mp4_tags(tags):
+    return type(tags).__name__ == 'MP4Tags'
+
+
+def read_mutagen_tags(file_path):
+    tags = load_mutagen(file_path).tags
+    raw_tags = {}
+    for tag in ID3_TAGS:
+        name = MP4_ITEM_NAMES[tag] if _is_mp4_tags(tags) else VORBIS_COMMENT_NAMES[tag]
+        values = tags.get(name)
+        if not values:
+            continue
+        if tag != 'track_num':
+            raw_tags[tag] = values[0]
+        elif _is_mp4_tags(tags):
+            raw_tags[tag] = values[0]
+        else:
+            match = re.match(r'\s*(\d+)', values[0])
+            raw_tags[tag] = (int(match.group(1)) if match else None, None)
+    return raw_tags
+
+
+def write_mutagen_tags(file_path, values, empty_override=False, encoding='utf8', padding=TAG_PADDING):
+    """
+    Vorbis comments of FLAC and Ogg files or MP4 items are written by mutagen, encoding is always UTF-8.
+    Current padding is kept when new tags fit in it, otherwise given one is reserved.
+    """
+    audio = load_mutagen(file_path)
+    tags = audio.tags
+    mp4 = _is_mp4_tags(tags)
+    for tag, value in zip(ID3_TAGS, values):
+        name = MP4_ITEM_NAMES[tag] if mp4 else VORBIS_COMMENT_NAMES[tag]
+        if value:
+            if tag != 'track_num':
+                tags[name] = [six.text_type(value)]
+            elif mp4:
+                total = tags[name][0][1] if tags.get(name) else 0
+                tags[name] = [(int(value), total)]
+            else:
+                tags[name] = [six.text_type(int(value))]
+        elif empty_override and name in tags:
+            del tags[name]
+
+    rewritten = []
+
+    def get_padding(info):
+        if info.padding >= 0:
+            return info.padding
+        rewritten.append(file_path)
+        return padding
+
+    audio.save(padding=get_padding)
+    return bool(rewritten)
+
+
+class TagBackend(object):
+    """
+    Tags of one audio format.
+
+    read returns raw values (see abp.readers) using header-only reader, raising TagReaderError when it can't,
+    full_read does the same with full parser. write saves values and returns True when whole file was rewritten.
+    magic tells whether first MAGIC_SIZE bytes of file belong to the format.
+    """
+    def __init__(self, name, extensions, magic, read, full_read, write):
+        self.name = name
+        self.extensions = extensions
+        self.magic = magic
+        self.read = read
+        self.full_read = full_read
+        self.write = write
+
+
+BACKENDS = collections.OrderedDict()  # name: TagBackend
+_extension_backends = {}
+
+
+def register_backend(backend):
+    """
+    Files with backend extensions are found by walk, its previous registration and extensions are replaced.
+    """
+    global AUDIO_FILE_PATTERN
+    BACKENDS[backend.name] = backend
+    for extension, extension_backend in list(_extension_backends.items()):
+        if extension_backend.name == backend.name:
+            del _extension_backends[extension]
+    for extension in backend.extensions:
+        _extension_backends[extension.lower()] = backend
+    AUDIO_FILE_PATTERN = re.compile(
+        r'.+(%s)$' % '|'.join(re.escape(extension) for extension in sorted(_extension_backends)), re.IGNORECASE
+    )
+
+
+def is_audio_file(file_name):
+    return os.path.splitext(file_name)[1].lower() in _extension_backends
+
+
+def get_backend(file_path):
+    """
+    Backend selected by file extension, raises ValueError when there is none.
+    """
+    try:
+        return _extension_backends[os.path.splitext(file_path)[1].lower()]
+    except KeyError:
+        raise ValueError('No tag backend for %s' % file_path)
+
+
+def detect_backend(file_path, preferred=None):
+    """
+    Backend selected by magic bytes, preferred one is checked first. None when none of them matches.
+    """
+    with open(file_path, 'rb') as fp:
+        header = fp.read(MAGIC_SIZE)
+    backends = list(BACKENDS.values())
+    if preferred is not None:
+        backends.insert(0, preferred)
+    for backend in backends:
+        if backend.magic(header):
+            return backend
+    return None
+
+
+_read_backends = collections.OrderedDict()  # absolute file path: TagBackend
+_read_backends_lock = threading.Lock()
+
+
+def remember_backend(file_path, backend):
+    with _read_backends_lock:
+        _read_backends[os.path.abspath(file_path)] = backend
+        while len(_read_backends) > BACKEND_CACHE_SIZE:
+            _read_backends.popitem(last=False)
+
+
+def recall_backend(file_path):
+    """
+    Returns backend which format of file was confirmed by when file was read, in this process, or None.
+    So file which is written after it's read, isn't opened again to detect it.
+    """
+    with _read_backends_lock:
+        return _read_backends.pop(os.path.abspath(file_path), None)
+
+
+def read_raw_tags(file_path):
+    """
+    Header-only reader of backend selected by extension is tried first, it fails for files of other format.
+    Then backend is detected by magic bytes, as extension may be wrong, and its readers are used.
+    """
+    backend = get_backend(file_path)
+    try:
+        tags = backend.read(file_path)
+        remember_backend(file_path, backend)
+        return tags
+    except TagReaderError:
+        pass
+
+    detected_backend = detect_backend(file_path, preferred=backend)
+    if detected_backend is not None:
+        remember_backend(file_path, detected_backend)
+    if detected_backend is not None and detected_backend is not backend:
+        backend = detected_backend
+        try:
+            return backend.read(file_path)
+        except TagReaderError:
+            pass
+
+    stats.incr('full_parser_fallbacks')
+    stats.incr('bytes_read', os.path.getsize(file_path))
+    return backend.full_read(file_path)
+
+
+def read_id3_values(file_path, index=None, stat=None):
+    """
+    Picklable wrapper of get_id3_values, which returns (values, error) instead of raising.
+    """
+    try:
+        return get_id3_values(file_path, index=index, stat=stat), None
+    except Exception as e:
+        return None, '%s: %s' % (type(e).__name__, e)
+
+
+def get_padded_tag_class():
+    """
+    Class is created on first use, as it subclasses eyeD3 Tag.
+    """
+    global _padded_tag_class
+    if _padded_tag_class is not None:
+        return _padded_tag_class
+
+    class PaddedTag(load_eyed3().id3.Tag):
+        """
+        Tag which reserves given padding when whole file has to be rewritten anyway,
+        so following edits fit in place and only tag bytes are written.
+        """
+        def __init__(self, padding=TAG_PADDING, **kwargs):
+            super(PaddedTag, self).__init__(**kwargs)
+            self.padding = padding
+            self.rewritten = False
+
+        def _render(self, version, curr_tag_size, max_padding_size):
+            rewrite_required, tag_data, padding = super(PaddedTag, self)._render(version, curr_tag_size,
+                                                                                 max_padding_size)
+            if rewrite_required:
+                # Rendered as if current tag had exactly wanted padding size, so it's used instead of default one.
+                _, tag_data, padding = super(PaddedTag, self)._render(version, len(tag_data) + self.padding, None)
+            self.rewritten = rewrite_required
+            return rewrite_required, tag_data, padding
+
+    _padded_tag_class = PaddedTag
+    return PaddedTag
+
+
+def write_id3_tags(file_path, values, empty_override=False, encoding='utf8', padding=TAG_PADDING):
+    """
+    Only tag is parsed before saving, eyed3.load would parse audio frames too.
+    When file has no tag, new one is created, like AudioFile.initTag does.
+    """
+    id3_tag = get_padded_tag_class()(padding=padding)
+    id3_tag.parse(file_path)
     for tag, value in zip(ID3_TAGS, values):
         if value or empty_override:
-            setattr(audiofile.tag, tag, id3_serialize(tag, value))
+            setattr(id3_tag, tag, id3_serialize(tag, value))
+
+    id3_tag.save(encoding=encoding)
+    return id3_tag.rewritten
+
+
+def save_id3_values(file_path, values, empty_override=False, encoding='utf8', padding=TAG_PADDING):
+    """
+    Tags are written by backend confirmed when file was read, otherwise by one detected by magic bytes
+    or selected by extension. encoding is used by ID3 tags only.
+
+    Returns True when whole file had to be rewritten, as new tag didn't fit in current one.
+    """
+    with stats.timer('write', file_path):
+        backend = recall_backend(file_path)
+        if backend is None:
+            backend = get_backend(file_path)
+            backend = detect_backend(file_path, preferred=backend) or backend
+        rewritten = backend.write(file_path, values, empty_override=empty_override, encoding=encoding,
+                                  padding=padding)
+    stats.incr('files_written')
+    if rewritten:
+        stats.incr('files_rewritten')
+    return rewritten
+
+
+def write_id3_values(item):
+    """
+    Picklable save_id3_values wrapper for executors.
+
+    Input: (file_path, values[], encoding, padding, empty_override)
+    """
+    file_path, values, encoding, padding, empty_override = item
+    return save_id3_values(file_path, values, empty_override=empty_override, encoding=encoding, padding=padding)
+
+
+register_backend(TagBackend('mp3', ['.mp3'], is_mp3_header, read_id3_tags, read_eyed3_tags, write_id3_tags))
+# FLAC files may start with ID3v2 tag too
+register_backend(TagBackend('flac', ['.flac'], lambda header: header[:4] == b'fLaC' or header[:3] == b'ID3',
+                            read_flac_tags, read_mutagen_tags, write_mutagen_tags))
+register_backend(TagBackend('ogg', ['.ogg', '.oga', '.opus'], lambda header: header[:4] == b'OggS',
+                            read_ogg_tags, read_mutagen_tags, write_mutagen_tags))
+register_backend(TagBackend('mp4', ['.m4a', '.m4b', '.mp4'], lambda header: header[4:8] == b'ftyp',
+                            read_mp4_tags, read_mutagen_tags, write_mutagen_tags))
+
+
+def get_written_key(stat):
+    return [stat.st_mtime, stat.st_ctime, stat.st_size]
+
+
+def is_modified_since(stat, since, file_path=None):
+    """
+    since is timestamp or Checkpoint. Files written by run which stored checkpoint are modified since
+    only when their stat changed after that run.
+    """
+    if stat is None:
+        return True
+    written = getattr(since, 'written', None)
+    if written and file_path is not None and written.get(os.path.abspath(file_path)) == get_written_key(stat):
+        return False
+    # ctime is checked too, as moved in files keep their modification time
+    return max(stat.st_mtime, stat.st_ctime) > float(since)
+
+
+def scan_folder(folder_dir, stat=True, since=None):
+    """
+    Lists directory once. When since timestamp is given, only files modified after it are returned.
+
+    Output: ([(file_name, stat)], sub_dirs[]), stat is None if not requested or failed.
+    """
+    stat = stat or since is not None
+    files = []
+    sub_dirs = []
+    with stats.timer('walk', folder_dir):
+        entries = list(scandir(folder_dir))
+    stats.incr('dirs_scanned')
+    stats.incr('files_scanned', len(entries))
+    for entry in entries:
+        if entry.is_dir():
+            if not entry.is_symlink():
+                sub_dirs.append(entry.path)
+        elif is_audio_file(entry.name):
+            file_stat = None
+            if stat:
+                try:
+                    file_stat = entry.stat()
+                except OSError:
+                    pass
+            file_name = normalize('NFC', entry.name)
+            if since is not None and not is_modified_since(file_stat, since, os.path.join(folder_dir, file_name)):
+                continue
+            files.append((file_name, file_stat))
+    files.sort()
+    sub_dirs.sort()
+    return files, sub_dirs
+
+
+def walk_folders(input_path, stat=True, since=None):
+    """
+    Single pass walk, each directory is listed only once.
+    All directories are still listed when since is given, as their modification time doesn't reflect files changes.
+
+    Output: (dir_path, [(file_name, stat)]) for directories with matched files
+    """
+    pending_dirs = [six.text_type(input_path)]
+    while pending_dirs:
+        path = pending_dirs.pop()
+        try:
+            files, sub_dirs = scan_folder(path, stat=stat, since=since)
+        except OSError:
+            continue
+        if files:
+            yield path, files
+        pending_dirs.extend(reversed(sub_dirs))
 
-    audiofile.tag.save(encoding=encoding)
 
+def scan_folders(folder_dirs, input_path='', stat=True, since=None):
+    """
+    Same output as walk_folders, but for given directories only.
+    """
+    for dir_path in folder_dirs:
+        files, _ = scan_folder(os.path.join(input_path, dir_path), stat=stat, since=since)
+        yield dir_path, files
+
+
+def get_folder_matched_files(folder_dir, since=None):
+    files, _ = scan_folder(folder_dir, stat=False, since=since)
+    for file_, _ in files:
+        yield file_
+
+
+def get_folder_dirs(input_path, since=None):
+    for path, _ in walk_folders(input_path, stat=False, since=since):
+        yield path
+
+
+def parse_timestamp(value):
+    """
+    Accepts unix timestamp or local date/time in ISO format.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for date_format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return time.mktime(datetime.datetime.strptime(value, date_format).timetuple())
+        except ValueError:
+            pass
+    raise ValueError('"%s" is neither timestamp nor date' % value)
+
+
+class Checkpoint(object):
+    """
+    Start time of run which applied changes, with files it wrote. Their stat after writing is kept,
+    so next run doesn't process them again, unless they are changed meanwhile.
+    """
+    def __init__(self, timestamp, written=None):
+        self.timestamp = timestamp
+        self.written = written or {}  # absolute file path: get_written_key
+
+    def __float__(self):
+        return float(self.timestamp)
+
+
+def read_checkpoint(checkpoint_path):
+    """
+    Returns Checkpoint stored in file or None when there is no checkpoint yet.
+    First line of file is timestamp, each following one is JSON list [file_path, mtime, ctime, size] of written file.
+    """
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path) as checkpoint_file:
+        lines = checkpoint_file.read().splitlines() or ['']
+    written = {}
+    for line in lines[1:]:
+        if line.strip():
+            record = json.loads(line)
+            written[record[0]] = record[1:]
+    return Checkpoint(parse_timestamp(lines[0].strip()), written)
+
+
+def write_checkpoint(checkpoint_path, timestamp, written_files=()):
+    """
+    timestamp should be start time of run, written_files are files it changed, see Checkpoint.
+    """
+    tmp_checkpoint_path = checkpoint_path + '.tmp'
+    with open(tmp_checkpoint_path, 'w') as checkpoint_file:
+        checkpoint_file.write('%f\n' % timestamp)
+        for file_path in written_files:
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            checkpoint_file.write(json.dumps([os.path.abspath(file_path)] + get_written_key(stat)) + '\n')
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)  # os.rename doesn't replace files on Windows
+    os.rename(tmp_checkpoint_path, checkpoint_path)
+
+
+class SerialExecutor(futures.Executor):
+    """
+    Executor running each submitted call immediately in the calling thread.
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+EXECUTORS = {
+    'serial': lambda jobs: SerialExecutor(),
+    'thread': lambda jobs: futures.ThreadPoolExecutor(max_workers=jobs),
+    'process': lambda jobs: futures.ProcessPoolExecutor(max_workers=jobs),
+}
 
-def get_folder_matched_files(folder_dir):
-    for file_ in os.listdir(folder_dir):
-        if not AUDIO_FILE_PATTERN.match(file_):
-            continue
-        yield normalize('NFC', file_)
 
+def get_executor(jobs=1, executor_type='thread'):
+    if jobs <= 1:
+        executor_type = 'serial'
+    return EXECUTORS[executor_type](jobs)
+
+
+def completed_future(result):
+    future = futures.Future()
+    future.set_result(result)
+    return future
+
+
+def iter_futures(pending_futures, window=64):
+    """
+    Keeps at most `window` futures pending, so their source is consumed lazily.
+    Futures are yielded in input order.
+    """
+    pending = collections.deque()
+    for future in pending_futures:
+        pending.append(future)
+        if len(pending) >= window:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+def iter_results(pending_futures, window=64):
+    """
+    Results of iter_futures.
+    """
+    for future in iter_futures(pending_futures, window=window):
+        yield future.result()
+
+
+def executor_map(executor, func, iterable, window=64):
+    """
+    Like executor.map, but input is consumed lazily.
+    """
+    return iter_results((executor.submit(func, item) for item in iterable), window=window)
+
+
+def iter_folders_id3_values(folders, input_path='', executor=None, index=None):
+    """
+    Input: (dir_path, [(file_name, stat)]) as yielded by walk_folders or scan_folders
+    Output: (dir_path, [(file_name, values[], error)])
+
+    Files are read by executor, but output order follows folders and files order.
+    Index is used only in calling thread, executor gets files not found in index.
+    """
+    executor = executor or SerialExecutor()
+
+    def folder_files():
+        for dir_path, files in folders:
+            for file_name, stat in files:
+                file_path = os.path.join(input_path, dir_path, file_name)
+                indexed_values = None
+                if index is not None and stat is not None:
+                    indexed_values = index.get(file_path, stat)
+                yield dir_path, file_name, file_path, stat, indexed_values
+
+    def read(file_path, indexed_values):
+        if indexed_values is not None:
+            return completed_future((indexed_values, None))
+        return executor.submit(read_id3_values, file_path)
+
+    files, files_to_read = itertools.tee(folder_files())
+    results = zip(files, iter_results(read(file_path, indexed_values)
+                                      for _, _, file_path, _, indexed_values in files_to_read))
+
+    def rows_values(rows):
+        for (_, file_name, file_path, stat, indexed_values), (values, error) in rows:
+            if index is not None and stat is not None and indexed_values is None and not error:
+                index.set(file_path, stat, values)
+            yield file_name, values, error
+
+    for dir_path, rows in itertools.groupby(results, key=lambda row: row[0][0]):
+        yield dir_path, list(rows_values(rows))
+
+
+def iter_id3_list(input_path, executor=None, index=None):
+    """
+    Streaming version of id3_list, each directory is yielded as soon as it's read.
+    """
+    folders = walk_folders(input_path, stat=index is not None)
+    for dir_path, rows in iter_folders_id3_values(folders, executor=executor, index=index):
+        path_values = []
 
-def get_folder_dirs(input_path):
-    for path, dirs, files in os.walk(six.text_type(input_path)):
-        if not any(get_folder_matched_files(path)):
-            continue
-        yield six.text_type(path)
+        for file_, id3_values, error in rows:
+            if error:
+                path_values.append({'file': file_, 'id3': [''] * len(ID3_TAGS), 'error': error})
+            else:
+                path_values.append({'file': file_, 'id3': id3_values})
 
+        yield {'dir': dir_path, 'files': path_values}
 
 
-def id3_list(input_path):
-    values = []
+def id3_list(input_path, executor=None, index=None):
+    return list(iter_id3_list(input_path, executor=executor, index=index))
 
-    for dir_path in get_folder_matched_files(input_path):
-        matched_files = get_folder_matched_files(dir_path)
-        path_values = []
 
-        for file_ in matched_files:
-            id3_values = get_id3_values(os.path.join(dir_path, file_))
-            path_values.append({'file': file_, 'id3': id3_values})
+def folder_id3_list(folder_path, index=None, files=None):
+    """
+    Files listed by walk_folders or scan_folder can be given, so folder is not listed again.
+    """
+    if files is None:
+        files, _ = scan_folder(folder_path, stat=index is not None)
+    for file_, stat in files:
+        id3_values = get_id3_values_dict(os.path.join(folder_path, file_), index=index, stat=stat)
+        yield {'file': os.path.join(folder_path, file_), 'id3': id3_values}
 
-        if path_values:
-            values.append({'dir': dir_path, 'files': path_values})
 
-    return values
+class PatternSet(object):
+    """
+    File patterns compiled once and searched one by one, first matched pattern wins.
+
+    Group names are mapped once per pattern. Literal text, which every match of a pattern has to contain,
+    is extracted when patterns are compiled, so pattern is searched only when file path contains it.
+    """
+    def __init__(self, patterns):
+        self.patterns = [pattern if hasattr(pattern, 'search') else re.compile(pattern) for pattern in patterns]
+        self.group_names = [
+            [name for name, _ in sorted(pattern.groupindex.items(), key=lambda item: item[1])]
+            for pattern in self.patterns
+        ]
+        self.required_literals = [get_required_literal(pattern) for pattern in self.patterns]
+        self._items = list(zip(self.patterns, self.required_literals, self.group_names))
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def search(self, file_path):
+        """
+        Output: (matched_pattern, matched_groups{}, matched_groups_span[(group, start, end)]) or None
+        """
+        for pattern, literal, group_names in self._items:
+            if literal and literal not in file_path:
+                continue
+            match = pattern.search(file_path)
+            if match:
+                break
+        else:
+            return None
+
+        matched_groups = dict((name.lower(), match.group(name)) for name in group_names)
+        matched_groups_span = [(name,) + match.span(name) for name in group_names if match.span(name) != (-1, -1)]
+        return pattern.pattern, matched_groups, matched_groups_span
+
+
+def get_required_literal(pattern):
+    """
+    Returns the longest literal text every match of pattern contains, or '' when there is none or it can't be
+    told safely, e.g. pattern ignores case. Only literals outside of alternations, repeats and character
+    classes are used, groups are followed only when they don't change flags.
+    """
+    if pattern.flags & re.IGNORECASE:
+        return pattern.pattern[:0]
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except (re.error, TypeError):
+        return pattern.pattern[:0]
+    to_char = six.int2byte if isinstance(pattern.pattern, bytes) else six.unichr
+    empty = pattern.pattern[:0]
+
+    runs = [[]]
+
+    def collect(items):
+        for op, value in items:
+            if op == sre_constants.LITERAL:
+                runs[-1].append(to_char(value))
+            elif op == sre_constants.SUBPATTERN and not any(value[1:-1]):
+                collect(value[-1])  # (group, add_flags, del_flags, items), only (group, items) on Python < 3.6
+            elif op == sre_constants.AT:
+                continue  # anchors match empty text, literals before and after it are still adjacent
+            else:
+                runs.append([])
 
+    collect(parsed)
+    return max((empty.join(run) for run in runs), key=len)
 
-def folder_id3_list(folder_path):
-    for file_ in get_folder_matched_files(folder_path):
-        id3_values = get_id3_values_dict(os.path.join(folder_path, file_))
-        yield {'file': os.path.join(folder_path, file_), 'id3': id3_values}
 
+def compile_patterns(file_patterns):
+    if isinstance(file_patterns, PatternSet):
+        return file_patterns
+    return PatternSet(file_patterns or [])
 
-GROUP_NAMES = {}
-def get_group_names(pattern):
-    text_pattern = pattern.pattern
-    if text_pattern not in GROUP_NAMES:
-        GROUP_NAMES[text_pattern] = re.findall(r'\?P<([^>]+)>', pattern.pattern)
-    return GROUP_NAMES[text_pattern]
 
+def match_pattern_folders(input_path, file_patterns, folders=None):
+    """
+    Yields directories (relative to input_path) with at least one file which path matches file_patterns.
+    Only directory listing is used, tags are not read. Directory check stops at first matched file.
 
-def get_file_id3_changes(id3_values, file_path, file_patterns, asciify, unescape):
+    folders: (dir_path, file_names[]) with dir_path relative to input_path, e.g. from library model.
+    Library is walked when not given.
+    """
+    file_patterns = compile_patterns(file_patterns)
+    if folders is None:
+        folders = ((os.path.relpath(dir_path, input_path), [file_name for file_name, _ in files])
+                   for dir_path, files in walk_folders(input_path, stat=False))
+
+    for dir_path, file_names in folders:
+        if any(file_patterns.search(os.path.normpath(os.path.join(dir_path, file_name))) is not None
+               for file_name in file_names):
+            yield dir_path
+
+
+def get_file_id3_changes(id3_values, file_path, file_patterns, asciify, unescape, folder_cache=None):
+    """
+    file_patterns should be PatternSet, so it's compiled once, not for each file.
+    folder_cache dict can be shared by files of one directory, see normalize_text.
+    """
     new_values = id3_values
     matched_pattern = None
-    matched_groups = None
     matched_groups_span = None
-    
-    for file_pattern in file_patterns:
-        match = file_pattern.search(file_path)
-        if not match:
-            continue
-        group_names = get_group_names(file_pattern)
-        matched_pattern = file_pattern.pattern
-        matched_groups_span = [(group,) + span for group, span in zip(group_names, match.regs[1:]) if span != (-1, -1)]
-        matched_groups = {key.lower(): value for key, value in match.groupdict().items()}
-        new_values = [(matched_groups.get(tag) or new_values[i]).strip() for i, tag in enumerate(ID3_TAGS)]
-        break
-
 
-    if unescape:
-        new_values = [html.unescape(cell) for cell in new_values]
+    with stats.timer('match', file_path):
+        match = compile_patterns(file_patterns).search(file_path)
+    if match:
+        matched_pattern, matched_groups, matched_groups_span = match
+        new_values = [(matched_groups.get(tag) or new_values[i]).strip() for i, tag in enumerate(ID3_TAGS)]
 
-    if asciify:
-        new_values = [unidecode(cell) for cell in new_values]
+    if unescape or asciify:
+        with stats.timer('normalize', file_path):
+            new_values = [normalize_text(cell, asciify, unescape, folder_cache) for cell in new_values]
 
     return matched_pattern, matched_groups_span, new_values
 
@@ -134,14 +890,48 @@ def prepare_id3_values_dict(values):
     return dict(zip(ID3_TAGS, values))
 
 
-def get_id3_values_dict(file_path):
-    values_list = get_id3_values(file_path)
+def prepare_rename_tags(values, file_name):
+    """
+    Tags available in rename pattern, besides ID3_TAGS $ext is file extension (without dot),
+    so files of mixed formats keep theirs.
+    """
+    tags = prepare_id3_values_dict(values)
+    tags['ext'] = os.path.splitext(file_name)[1][1:]
+    return tags
+
+
+def get_id3_values_dict(file_path, index=None, stat=None):
+    values_list = get_id3_values(file_path, index=index, stat=stat)
     return prepare_id3_values_dict(values_list)
 
 
-def get_id3_changes(input_path, empty_override, file_patterns, asciify, unescape, folder_dirs=None):
+def read_folders_values(input_path, folder_dirs=None, executor=None, index=None, since=None, folders_values=None):
+    """
+    Reads values of whole library or given directories, unless already read folders_values are given,
+    e.g. by library model, with directory paths relative to input_path.
+
+    Output: ((dir_path, [(file_name, values[], error)]), root), dir_path is relative to root.
+    """
+    # walked directory paths already start with input_path, given ones are relative to it
+    if folders_values is not None:
+        return folders_values, input_path
     if folder_dirs is None:
-        folder_dirs = get_folder_dirs(input_path)
+        folders, root = walk_folders(input_path, stat=index is not None, since=since), ''
+    else:
+        folders, root = scan_folders(folder_dirs, input_path, stat=index is not None, since=since), input_path
+    return iter_folders_id3_values(folders, root, executor=executor, index=index), root
+
+
+def iter_id3_changes(input_path, empty_override, file_patterns, asciify, unescape, folder_dirs=None, executor=None,
+                     index=None, since=None, folders_values=None):
+    """
+    Streaming version of get_id3_changes, changes are yielded as soon as directory is processed.
+    When since timestamp is given, only files modified after it are checked.
+
+    Output: (dir_path, [(file_name, new_values[], old_values[])], [(file_name, reason)])
+    """
+    folders_values, _ = read_folders_values(input_path, folder_dirs, executor, index, since, folders_values)
+    file_patterns = compile_patterns(file_patterns)
     if empty_override:
         def record_equals(values, changes):
             return values == changes
@@ -152,19 +942,19 @@ def get_id3_changes(input_path, empty_override, file_patterns, asciify, unescape
                     return False
             return True
 
-    all_changes = []  # (dir_path, [(file_name, new_values[], old_values[])])
-    ignored_files = []  # (dir_path, [(file_name, reason)])
-
-    for dir_path in folder_dirs:
-        matched_files = get_folder_matched_files(os.path.join(input_path, dir_path))
+    for dir_path, rows in folders_values:
         path_changes = []
         path_ingored_files = []
+        folder_cache = {}
 
-        for file_name in matched_files:
-            file_path = os.path.join(dir_path, file_name)
-            values = get_id3_values(os.path.join(input_path, file_path))
+        for file_name, values, error in rows:
+            if error:
+                path_ingored_files.append((file_name, 'Read error - %s' % error))
+                continue
 
-            matched_pattern, matched_groups, new_values = get_file_id3_changes(values, file_path, file_patterns, asciify, unescape)
+            file_path = os.path.join(dir_path, file_name)
+            matched_pattern, matched_groups, new_values = get_file_id3_changes(values, file_path, file_patterns, asciify, unescape,
+                                                                               folder_cache)
 
             if record_equals(values, new_values):
                 if file_patterns and values is new_values:
@@ -175,6 +965,17 @@ def get_id3_changes(input_path, empty_override, file_patterns, asciify, unescape
             else:
                 path_changes.append((file_name, new_values, values))
 
+        yield dir_path, path_changes, path_ingored_files
+
+
+def get_id3_changes(input_path, empty_override, file_patterns, asciify, unescape, folder_dirs=None, executor=None,
+                    index=None, since=None, folders_values=None):
+    all_changes = []  # (dir_path, [(file_name, new_values[], old_values[])])
+    ignored_files = []  # (dir_path, [(file_name, reason)])
+
+    for dir_path, path_changes, path_ingored_files in iter_id3_changes(
+            input_path, empty_override, file_patterns, asciify, unescape,
+            folder_dirs=folder_dirs, executor=executor, index=index, since=since, folders_values=folders_values):
         if path_ingored_files:
             ignored_files.append((dir_path, path_ingored_files))
         if path_changes:
@@ -183,20 +984,83 @@ def get_id3_changes(input_path, empty_override, file_patterns, asciify, unescape
     return all_changes, ignored_files
 
 
-def apply_changes(changes, encoding, input_path='.'):
+def get_written_values(new_values, old_values, empty_override=False):
+    """
+    Values which are read from file after new_values are written, as serialization may change them,
+    e.g. track number padding. Empty values are written only with empty_override.
+    """
+    return [id3_deserialize(tag, id3_serialize(tag, new_value)) if new_value or empty_override else old_value
+            for tag, new_value, old_value in zip(ID3_TAGS, new_values, old_values)]
+
+
+def apply_changes(changes, encoding, input_path='.', index=None, executor=None, padding=TAG_PADDING,
+                  rewritten=None, errors=None, progress=None, empty_override=False, journal=None):
+    """
+    Files are written by executor, index is updated in calling thread.
+    Files which had to be rewritten whole are appended to rewritten list, if given.
+    When errors list is given, files which couldn't be written are appended to it as (file_path, reason),
+    otherwise first error is raised. progress is called with file_path after each file.
+    When journal (see abp.journal) is given, all files with their old values are planned in it
+    before first one is written and each written file is marked done.
+    """
+    executor = executor or SerialExecutor()
+
+    def files_to_write():
+        for dir_path, rows in changes:
+            for file_name, new_values, old_values in rows:
+                file_path = os.path.join(dir_path, file_name)
+                yield file_path, os.path.join(input_path, file_path), new_values, old_values
+
+    files = files_to_write()
+    if journal is not None:
+        files = list(files)
+        for _, full_file_path, new_values, old_values in files:
+            journal.plan(os.path.abspath(full_file_path), file=os.path.abspath(full_file_path), new=list(new_values),
+                         old=list(old_values))
+        journal.sync()
+    files, files_to_save = itertools.tee(files)
+    items = ((full_file_path, new_values, encoding, padding, empty_override)
+             for _, full_file_path, new_values, _ in files_to_save)
+
     changed_files = []
-    for dir_path, rows in changes:
-        for file_name, new_values, old_values in rows:
-            file_path = os.path.join(dir_path, file_name)
-            save_id3_values(os.path.join(input_path, file_path), new_values, encoding=encoding)
-            changed_files.append(file_path)
+    for (file_path, full_file_path, new_values, old_values), future in zip(
+            files, iter_futures(executor.submit(write_id3_values, item) for item in items)):
+        try:
+            file_rewritten = future.result()
+        except Exception as e:
+            if errors is None:
+                raise
+            errors.append((file_path, '%s: %s' % (type(e).__name__, e)))
+            if journal is not None:
+                journal.error(os.path.abspath(full_file_path), errors[-1][1])
+            if progress is not None:
+                progress(file_path)
+            continue
+
+        if journal is not None:
+            journal.done(os.path.abspath(full_file_path))
+
+        if index is not None:
+            index.set(full_file_path, os.stat(full_file_path),
+                      get_written_values(new_values, old_values, empty_override))
+        if file_rewritten and rewritten is not None:
+            rewritten.append(file_path)
+        changed_files.append(file_path)
+        if progress is not None:
+            progress(file_path)
+    if index is not None:
+        index.commit()  # calling thread, e.g. UI job worker, doesn't hold index write lock afterwards
     return changed_files
 
 
 def mkdirnotex(filename):
     folder = os.path.dirname(filename)
     if not os.path.exists(folder):
-        os.makedirs(folder)
+        try:
+            os.makedirs(folder)
+        except OSError:
+            if not os.path.isdir(folder):  # created by another thread in the meantime
+                raise
 
 
 def is_rename_fully_matched(file_pattern, tags, file_path):
@@ -210,52 +1074,147 @@ def is_rename_fully_matched(file_pattern, tags, file_path):
     return new_file_path != file_path
 
 
+def match_rename_folders(input_path, file_path_pattern, index=None, since=None, folders_values=None):
+    """
+    Yields directories (relative to input_path) which all files are fully matched by pattern,
+    see is_rename_fully_matched. Directory check stops at first not matched file, so rest of its files is not read.
+    Files which tags couldn't be read are not matched.
+    """
+    def is_file_matched(dir_path, file_name, values, error):
+        file_path = os.path.normpath(os.path.join(dir_path, file_name))
+        return not error and is_rename_fully_matched(file_path_pattern, prepare_rename_tags(values, file_name),
+                                                     file_path)
+
+    if folders_values is not None:
+        for dir_path, rows in folders_values:
+            if all(is_file_matched(dir_path, *row) for row in rows):
+                yield dir_path
+        return
+
+    for dir_path, files in walk_folders(input_path, stat=index is not None, since=since):
+        dir_path = os.path.relpath(dir_path, input_path)
+        if all(is_file_matched(dir_path, file_name,
+                               *read_id3_values(os.path.join(input_path, dir_path, file_name), index, stat))
+               for file_name, stat in files):
+            yield dir_path
+
+
 def get_rename(file_pattern, tags):
     new_file_path = file_pattern
-    if 'track_num' in tags:
+    if tags.get('track_num'):
         tags['track_num'] = '%0.2d' % int(tags['track_num'])
     for name, value in tags.items():
         new_file_path = new_file_path.replace('$' + name, value)
     return re.sub(r'[:?*<>|]', '', new_file_path)
 
 
-def get_renames(input_path, file_path_pattern, folder_dirs=None):
-    if folder_dirs is None:
-        folder_dirs = get_folder_dirs(input_path)
-
-    all_renames = []  # (dir_path, [(new_file_path, old_file_path,)])
+def iter_renames(input_path, file_path_pattern, folder_dirs=None, executor=None, errors=None, index=None, since=None,
+                 folders_values=None):
+    """
+    Streaming version of get_renames, renames are yielded as soon as directory is processed.
+    Errors of directory are appended to `errors` before its renames are yielded.
 
-    for dir_path in folder_dirs:
-        dir_path = os.path.join(input_path, dir_path)
+    Output: (dir_path, [(new_file_path, old_file_path,)])
+    """
+    folders_values, root = read_folders_values(input_path, folder_dirs, executor, index, since, folders_values)
 
-        matched_files = get_folder_matched_files(dir_path)
+    for dir_path, rows in folders_values:
+        dir_path = os.path.join(root, dir_path)
         path_renames = []
 
-        for file_name in matched_files:
+        for file_name, values, error in rows:
+            if error:
+                if errors is not None:
+                    errors.append((dir_path, file_name, error))
+                continue
+
             old_file_path = os.path.join(dir_path, file_name)
-            tags = get_id3_values_dict(old_file_path)
+            tags = prepare_rename_tags(values, file_name)
             new_file_path = get_rename(file_path_pattern, tags)
             path_renames.append((new_file_path, os.path.relpath(old_file_path, input_path)))
 
         if path_renames:
-            all_renames.append((dir_path, path_renames))
-
-    return all_renames
-
+            yield dir_path, path_renames
+
+
+def get_renames(input_path, file_path_pattern, folder_dirs=None, executor=None, errors=None, index=None, since=None,
+                folders_values=None):
+    """
+    Files which tags couldn't be read are skipped and appended to `errors` as (dir_path, file_name, reason).
+    """
+    return list(iter_renames(input_path, file_path_pattern, folder_dirs=folder_dirs, executor=executor, errors=errors,
+                             index=index, since=since, folders_values=folders_values))
+
+
+
+
+def rename_file(item):
+    """
+    Picklable apply_renames step for executors.
+
+    Input: (old_full_file_path, new_full_file_path)
+    Returns True when file was moved.
+    """
+    old_full_file_path, new_full_file_path = item
+    mkdirnotex(new_full_file_path)
+    if old_full_file_path == new_full_file_path:
+        return False
+    with stats.timer('rename', new_full_file_path):
+        copied = move_file(old_full_file_path, new_full_file_path)
+    stats.incr('files_moved')
+    if copied:
+        stats.incr('files_copied')
+    return True
+
+
+def apply_renames(renames, input_path, output_path, index=None, errors=None, progress=None, executor=None,
+                  journal=None):
+    """
+    Files are moved by executor, see abp.moves, so output path can be on another filesystem.
+    Index is updated in calling thread.
+    When errors list is given, files which couldn't be renamed are appended to it as (old_file_path, reason),
+    otherwise first error is raised. progress is called with old_file_path after each file.
+    When journal (see abp.journal) is given, all renames are planned in it before first file is moved
+    and each moved file is marked done.
+    """
+    executor = executor or SerialExecutor()
+
+    def files_to_rename():
+        for dir_path, rows in renames:
+            for new_file_path, old_file_path in rows:
+                yield old_file_path, os.path.join(input_path, old_file_path), os.path.join(output_path, new_file_path)
+
+    files = files_to_rename()
+    if journal is not None:
+        files = list(files)
+        for _, old_full_file_path, new_full_file_path in files:
+            journal.plan(os.path.abspath(old_full_file_path), old=os.path.abspath(old_full_file_path),
+                         new=os.path.abspath(new_full_file_path))
+        journal.sync()
+    files, files_to_move = itertools.tee(files)
+    moves = iter_futures(executor.submit(rename_file, (old_full_file_path, new_full_file_path))
+                         for _, old_full_file_path, new_full_file_path in files_to_move)
 
-
-
-def apply_renames(renames, input_path, output_path):
     changed_files = []
-
-    for dir_path, rows in renames:
-        for new_file_path, old_file_path in rows:
-            new_full_file_path = os.path.join(output_path, new_file_path)
-            old_full_file_path = os.path.join(input_path, old_file_path)
-
-            mkdirnotex(new_full_file_path)
-            if old_full_file_path != new_full_file_path:
-                os.rename(old_full_file_path, new_full_file_path)
+    for (old_file_path, old_full_file_path, new_full_file_path), future in zip(files, moves):
+        try:
+            moved = future.result()
+        except EnvironmentError as e:
+            if errors is None:
+                raise
+            errors.append((old_file_path, '%s: %s' % (type(e).__name__, e)))
+            if journal is not None:
+                journal.error(os.path.abspath(old_full_file_path), errors[-1][1])
+        else:
+            if journal is not None:
+                journal.done(os.path.abspath(old_full_file_path))
+            if moved:
+                if index is not None:
+                    index.rename(old_full_file_path, new_full_file_path)
                 changed_files.append(new_full_file_path)
+        if progress is not None:
+            progress(old_file_path)
+    if index is not None:
+        index.commit()
     return changed_files
 
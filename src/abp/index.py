@@ -0,0 +1,161 @@
+"""
+Persistent tag index stored in user cache directory, one database for each library root.
+
+It keeps deserialized ID3_TAGS values of each file keyed by path, modification time and size,
+so unchanged files don't need to be parsed again. Rows of files removed outside of abp are pruned
+once a day.
+
+Database is used in WAL mode, so reading threads aren't blocked by writing one. Writing thread commits
+its rows at least every COMMIT_INTERVAL, so other writers, e.g. UI watcher during apply job, wait at most that long.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+COMMIT_EVERY = 1000
+COMMIT_INTERVAL = 1.0  # seconds, longest time rows are kept uncommitted, holding write lock
+LOCK_TIMEOUT = 30  # seconds writer waits for lock held by another connection
+PRUNE_EVERY = 24 * 60 * 60  # seconds between checks of indexed files which no longer exist
+
+
+def get_cache_dir():
+    """
+    ABP_CACHE_DIR when set, otherwise abp directory in XDG_CACHE_HOME or ~/.cache.
+    """
+    cache_dir = os.environ.get('ABP_CACHE_DIR')
+    if cache_dir:
+        return cache_dir
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'abp')
+
+
+def get_index_path(root):
+    root = os.path.abspath(root)
+    root_id = hashlib.sha1(root if isinstance(root, bytes) else root.encode('utf8')).hexdigest()[:16]
+    return os.path.join(get_cache_dir(), 'index-%s.sqlite' % root_id)
+
+
+def stat_key(stat):
+    mtime = getattr(stat, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(stat.st_mtime * 1000000000)
+    return mtime, stat.st_size
+
+
+class TagIndex(object):
+    def __init__(self, root, path=None):
+        self.root = os.path.abspath(root)
+        self.path = path or get_index_path(self.root)
+        self._local = threading.local()
+        self._connection()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')  # index can be rebuilt, so commits aren't fsynced
+            connection.execute('CREATE TABLE IF NOT EXISTS files '
+                               '(path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, tags TEXT)')
+            connection.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+            connection.commit()
+            self._local.connection = connection
+            self._local.pending = 0
+        return connection
+
+    def _execute(self, query, params):
+        connection = self._connection()
+        connection.execute(query, params)
+        if not self._local.pending:
+            self._local.first_pending = time.time()
+        self._local.pending += 1
+        if self._local.pending >= COMMIT_EVERY or time.time() - self._local.first_pending >= COMMIT_INTERVAL:
+            self.commit()
+
+    def key(self, file_path):
+        return os.path.relpath(os.path.abspath(file_path), self.root)
+
+    def contains(self, file_path):
+        return not self.key(file_path).startswith(os.pardir)
+
+    def get(self, file_path, stat):
+        """
+        Returns stored values or None when file is not indexed or has been changed since.
+        """
+        mtime, size = stat_key(stat)
+        row = self._connection().execute('SELECT tags FROM files WHERE path = ? AND mtime = ? AND size = ?',
+                                         (self.key(file_path), mtime, size)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, file_path, stat, values):
+        if not self.contains(file_path):
+            return
+        mtime, size = stat_key(stat)
+        self._execute('INSERT OR REPLACE INTO files (path, mtime, size, tags) VALUES (?, ?, ?, ?)',
+                      (self.key(file_path), mtime, size, json.dumps(values)))
+
+    def remove(self, file_path):
+        self._execute('DELETE FROM files WHERE path = ?', (self.key(file_path),))
+
+    def rename(self, old_file_path, new_file_path):
+        if not self.contains(new_file_path):
+            self.remove(old_file_path)
+            return
+        self._execute('DELETE FROM files WHERE path = ?', (self.key(new_file_path),))
+        self._execute('UPDATE files SET path = ? WHERE path = ?',
+                      (self.key(new_file_path), self.key(old_file_path)))
+
+    def prune(self, every=PRUNE_EVERY):
+        """
+        Removes rows of files which no longer exist, e.g. deleted or renamed outside of abp.
+        Files are checked at most once per `every` seconds, 0 checks them now. Returns number of removed rows.
+        """
+        connection = self._connection()
+        now = time.time()
+        row = connection.execute("SELECT value FROM meta WHERE name = 'pruned'").fetchone()
+        if row and now - float(row[0]) < every:
+            return 0
+        stale = [(path,) for path, in connection.execute('SELECT path FROM files')
+                 if not os.path.exists(os.path.join(self.root, path))]
+        connection.executemany('DELETE FROM files WHERE path = ?', stale)
+        connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('pruned', ?)", (repr(now),))
+        connection.commit()
+        return len(stale)
+
+    def commit(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.commit()
+            self._local.pending = 0
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.commit()
+            connection.close()
+            self._local.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_index(root, path=None):
+    """
+    Returns TagIndex, with rows of removed files pruned when due, or None when index file can't be used,
+    e.g. cache directory is read-only.
+    """
+    path = path or get_index_path(root)
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        index = TagIndex(root, path)
+        index.prune()
+        return index
+    except (sqlite3.Error, EnvironmentError):
+        return None
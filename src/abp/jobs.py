@@ -0,0 +1,128 @@
+"""
+Background jobs run by UI, so applying changes to many files doesn't block requests.
+
+Job function gets Job as first argument. It sets job total, passes job.progress as progress callback
+and job.errors as errors list to apply functions. Progress callback raises JobCancelled once job is cancelled,
+so job stops after current file.
+"""
+import time
+import uuid
+import threading
+import collections
+
+from concurrent import futures
+
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATUSES = (DONE, FAILED, CANCELLED)
+
+MAX_FINISHED_JOBS = 100
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job(object):
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = PENDING
+        self.total = None
+        self.done = 0
+        self.errors = []
+        self.error = None
+        self.result = None
+        self.started = None
+        self.finished = None
+        self._cancelled = threading.Event()
+
+    def progress(self, *args):
+        self.done += 1
+        if self._cancelled.is_set():
+            raise JobCancelled()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def to_dict(self):
+        elapsed = self.elapsed()
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'total': self.total,
+            'done': self.done,
+            'errors': self.errors,
+            'error': self.error,
+            'elapsed': elapsed,
+            'throughput': self.done / elapsed if elapsed else 0.0,
+            'result': self.result if self.status == DONE else None,
+        }
+
+
+class JobQueue(object):
+    """
+    Jobs run in order by `workers` threads. Single worker by default, so jobs changing same files don't overlap.
+    """
+    def __init__(self, workers=1):
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self.jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _run(self, job, func, args, kwargs):
+        if job.cancelled:
+            job.status = CANCELLED
+            return
+        job.status = RUNNING
+        job.started = time.time()
+        try:
+            job.result = func(job, *args, **kwargs)
+            job.status = DONE
+        except JobCancelled:
+            job.status = CANCELLED
+        except Exception as e:
+            job.error = '%s: %s' % (type(e).__name__, e)
+            job.status = FAILED
+        finally:
+            job.finished = time.time()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in FINISHED_STATUSES]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def submit(self, name, func, *args, **kwargs):
+        job = Job(name)
+        with self._lock:
+            self._prune()
+            self.jobs[job.id] = job
+        self.executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job.cancel()
+        return job
+
+    def shutdown(self, wait=True):
+        for job in list(self.jobs.values()):
+            job.cancel()
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,284 @@
+"""
+Append-only journal of applied changes and renames, stored in library root.
+
+Each run starts with begin record, then all planned files are written (with old values or paths)
+and synced before first file is changed. Each finished file gets done (or error) record and run ends
+with end record. Run without end record was interrupted, it can be resumed without scanning library again.
+Finished or interrupted runs can be undone, latest first.
+
+Records are JSON objects, one per line. Line broken by crash is ignored when journal is read.
+Once run ends, journal is compacted to KEEP_RUNS latest runs which can still be undone.
+"""
+import os
+import json
+import time
+import uuid
+import threading
+import collections
+
+from abp.core import SerialExecutor, TAG_PADDING, apply_changes, apply_renames
+
+
+JOURNAL_FILE_NAME = '.abp-journal'
+SYNC_EVERY = 100  # done records between fsyncs, process crash loses nothing as each record is flushed
+KEEP_RUNS = 10
+
+ID3 = 'id3'
+RENAME = 'rename'
+UNDO = 'undo'
+
+
+class JournalError(Exception):
+    pass
+
+
+class Run(object):
+    def __init__(self, run_id, kind, params):
+        self.id = run_id
+        self.kind = kind
+        self.params = params
+        self.planned = collections.OrderedDict()  # key: record
+        self.done = set()
+        self.errors = {}  # key: reason
+        self.finished = False
+        self.undone = False
+
+    def pending(self):
+        return [record for key, record in self.planned.items() if key not in self.done]
+
+    def completed(self):
+        return [record for key, record in self.planned.items() if key in self.done]
+
+
+def read_runs(path):
+    """
+    Output: [Run] in order they were started. Undo runs mark their target runs as undone once finished
+    without errors.
+    """
+    runs = collections.OrderedDict()
+    if not os.path.exists(path):
+        return []
+    with open(path) as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # write interrupted by crash
+            op = record.get('op')
+            if op == 'begin':
+                runs[record['run']] = Run(record['run'], record['kind'], record.get('params', {}))
+                continue
+            run = runs.get(record.get('run'))
+            if run is None:
+                continue
+            if op == 'plan':
+                run.planned[record['key']] = record
+            elif op == 'done':
+                run.done.add(record['key'])
+            elif op == 'error':
+                run.errors[record['key']] = record['reason']
+            elif op == 'end':
+                run.finished = True
+                target = runs.get(run.params.get('target'))
+                if run.kind == UNDO and target is not None and not run.errors:
+                    target.undone = True
+    return list(runs.values())
+
+
+def iter_run_records(run):
+    """
+    Records of run, without ones of its resumes and repeated done records.
+    """
+    yield {'op': 'begin', 'run': run.id, 'kind': run.kind, 'params': run.params}
+    for record in run.planned.values():
+        yield record
+    for key in run.planned:
+        if key in run.done:
+            yield {'op': 'done', 'run': run.id, 'key': key}
+    for key, reason in run.errors.items():
+        yield {'op': 'error', 'run': run.id, 'key': key, 'reason': reason}
+    if run.finished:
+        yield {'op': 'end', 'run': run.id}
+
+
+class Journal(object):
+    def __init__(self, root, file_name=JOURNAL_FILE_NAME):
+        self.path = os.path.join(os.path.abspath(root), file_name)
+        self.run = None
+        self._fp = open(self.path, 'a')
+        self._unsynced = 0
+        self._lock = threading.Lock()
+        if self._fp.tell() and not self._ends_with_newline():
+            self._fp.write('\n')  # line broken by crash is ended, so following record isn't merged with it
+
+    def _ends_with_newline(self):
+        with open(self.path, 'rb') as fp:
+            fp.seek(-1, os.SEEK_END)
+            return fp.read(1) == b'\n'
+
+    def _write(self, record, sync=False):
+        with self._lock:
+            self._fp.write(json.dumps(record, sort_keys=True) + '\n')
+            self._fp.flush()
+            self._unsynced += 1
+            if sync or self._unsynced >= SYNC_EVERY:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._fp.fileno())
+        self._unsynced = 0
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def begin(self, kind, **params):
+        self.run = Run(uuid.uuid4().hex, kind, params)
+        self._write({'op': 'begin', 'run': self.run.id, 'kind': kind, 'params': params, 'time': time.time()},
+                    sync=True)
+        return self.run
+
+    def resume(self, run):
+        """
+        Following records are appended to given, interrupted run.
+        """
+        self.run = run
+        self._write({'op': 'resume', 'run': run.id, 'time': time.time()})
+
+    def plan(self, key, **values):
+        """
+        Already planned files are skipped, e.g. when run is resumed. sync has to be called before files are changed.
+        """
+        if key in self.run.planned:
+            return
+        record = dict(values, op='plan', run=self.run.id, key=key)
+        self.run.planned[key] = record
+        self._write(record)
+
+    def done(self, key):
+        self.run.done.add(key)
+        self._write({'op': 'done', 'run': self.run.id, 'key': key})
+
+    def error(self, key, reason):
+        self.run.errors[key] = reason
+        self._write({'op': 'error', 'run': self.run.id, 'key': key, 'reason': reason})
+
+    def end(self):
+        self._write({'op': 'end', 'run': self.run.id, 'time': time.time()}, sync=True)
+        self.run.finished = True
+        self.compact()
+
+    def compact(self):
+        """
+        Journal is rewritten with KEEP_RUNS latest runs which can still be undone, so it doesn't grow with each run.
+        Undo runs and runs they undid are dropped. Journal is replaced atomically, crash leaves old or new one.
+        """
+        with self._lock:
+            runs = read_runs(self.path)
+            kept = [run for run in runs if run.kind != UNDO and not run.undone and run.planned][-KEEP_RUNS:]
+            if len(kept) == len(runs):
+                return
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as fp:
+                for run in kept:
+                    for record in iter_run_records(run):
+                        fp.write(json.dumps(record, sort_keys=True) + '\n')
+                fp.flush()
+                os.fsync(fp.fileno())
+            self._fp.close()
+            getattr(os, 'replace', os.rename)(tmp_path, self.path)  # os.replace is missing in Python 2
+            self._fp = open(self.path, 'a')
+            self._unsynced = 0
+
+    def close(self):
+        with self._lock:
+            if self._unsynced:
+                self._sync()
+            self._fp.close()
+
+
+def open_journal(root, file_name=JOURNAL_FILE_NAME):
+    """
+    Returns Journal or None when journal file can't be written, e.g. library is read-only.
+    """
+    try:
+        return Journal(root, file_name)
+    except EnvironmentError:
+        return None
+
+
+def interrupted_run(journal, kind):
+    """
+    Returns last run of journal when it was interrupted, raises JournalError otherwise.
+    """
+    runs = read_runs(journal.path)
+    if not runs or runs[-1].finished or not runs[-1].planned:
+        raise JournalError('There is no interrupted run to resume in %s' % journal.path)
+    run = runs[-1]
+    if run.kind != kind:
+        raise JournalError('Interrupted run is %s, not %s' % (run.kind, kind))
+    return run
+
+
+def undoable_run(journal):
+    """
+    Returns last run which changed any file and wasn't undone, raises JournalError when there is none.
+    """
+    for run in reversed(read_runs(journal.path)):
+        if run.kind != UNDO and not run.undone and run.planned:
+            return run
+    raise JournalError('There is nothing to undo in %s' % journal.path)
+
+
+def resume_changes(journal, run, index=None, executor=None, rewritten=None, errors=None, progress=None):
+    """
+    Applies changes of interrupted id3 run which weren't done yet.
+    """
+    journal.resume(run)
+    changes = [(os.path.dirname(record['file']), [(os.path.basename(record['file']), record['new'], record['old'])])
+               for record in run.pending()]
+    apply_changes(changes, run.params.get('encoding', 'utf8'), index=index, executor=executor,
+                  padding=run.params.get('padding', TAG_PADDING), empty_override=run.params.get('empty_override', False),
+                  rewritten=rewritten, errors=errors, progress=progress, journal=journal)
+    journal.end()
+
+
+def resume_renames(journal, run, index=None, executor=None, errors=None, progress=None):
+    """
+    Applies renames of interrupted rename run which weren't done yet. Files moved before their done record
+    was written (source is missing and target exists) are only marked done.
+    """
+    journal.resume(run)
+    rows = []
+    for record in run.pending():
+        if not os.path.exists(record['old']) and os.path.exists(record['new']):
+            journal.done(record['key'])
+        else:
+            rows.append((record['new'], record['old']))
+    apply_renames([('', rows)], '', '', index=index, errors=errors, progress=progress, executor=executor,
+                  journal=journal)
+    journal.end()
+
+
+def undo_run(journal, run, index=None, executor=None, errors=None, progress=None):
+    """
+    Restores old values of changed files, or moves renamed files back, latest first. Undo is journaled
+    as run of its own, so undone run is skipped by following undo. Interrupted undo is finished by running it again.
+
+    Tags are undone only for files with done record. For renames files are checked instead, as file could be
+    moved just before interruption.
+    """
+    journal.begin(UNDO, target=run.id, target_kind=run.kind)
+    if run.kind == ID3:
+        changes = [(os.path.dirname(record['file']), [(os.path.basename(record['file']), record['old'], record['new'])])
+                   for record in reversed(run.completed())]
+        apply_changes(changes, run.params.get('encoding', 'utf8'), index=index, executor=executor,
+                      padding=run.params.get('padding', TAG_PADDING), empty_override=True, errors=errors,
+                      progress=progress, journal=journal)
+    else:
+        rows = [(record['old'], record['new']) for record in reversed(list(run.planned.values()))
+                if os.path.exists(record['new']) and not os.path.exists(record['old'])]
+        # Files are moved back one by one, as later rename could depend on earlier one.
+        apply_renames([('', rows)], '', '', index=index, errors=errors, progress=progress, executor=SerialExecutor(),
+                      journal=journal)
+    journal.end()
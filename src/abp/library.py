@@ -0,0 +1,178 @@
+"""
+Long-lived in-memory model of library, used by UI instead of scanning library on each request.
+
+Library is walked and its tags are read once. Each directory keeps tuple of (file_name, stat_key, values, error)
+rows, values being tuple of ID3_TAGS values. Directories are refreshed one by one, re-reading only files
+which modification time or size changed.
+"""
+import os
+import bisect
+import hashlib
+import threading
+
+from abp.core import ID3_TAGS, walk_folders, scan_folder, iter_folders_id3_values
+from abp.index import stat_key
+
+
+class Library(object):
+    def __init__(self, input_path, index=None, executor=None):
+        self.input_path = input_path
+        self.index = index
+        self.executor = executor
+        self._folders = {}  # dir_path relative to input_path: rows
+        self._lock = threading.Lock()
+
+    def _dir_path(self, path):
+        return os.path.normpath(os.path.relpath(path, self.input_path))
+
+    def _read(self, folders):
+        """
+        Input: [(dir_path, [(file_name, stat)])] with dir_path relative to input_path
+        Output: {dir_path: rows}, unchanged files values are taken from current rows.
+        """
+        read_folders = {}
+        folders_to_read = []
+        for dir_path, files in folders:
+            known_rows = dict((row[0], row) for row in self._folders.get(dir_path, ()))
+            read_folders[dir_path] = {}
+            files_to_read = []
+            for file_name, stat in files:
+                row = known_rows.get(file_name)
+                if stat is not None and row is not None and row[1] == stat_key(stat):
+                    read_folders[dir_path][file_name] = row
+                else:
+                    files_to_read.append((file_name, stat))
+            if files_to_read:
+                folders_to_read.append((dir_path, files_to_read))
+
+        stats = dict(((dir_path, file_name), stat)
+                     for dir_path, files in folders_to_read for file_name, stat in files)
+        for dir_path, rows in iter_folders_id3_values(folders_to_read, self.input_path, executor=self.executor,
+                                                      index=self.index):
+            for file_name, values, error in rows:
+                stat = stats[(dir_path, file_name)]
+                read_folders[dir_path][file_name] = (
+                    file_name,
+                    stat_key(stat) if stat is not None else None,
+                    tuple(values) if not error else None,
+                    error
+                )
+
+        if self.index is not None:
+            self.index.commit()
+        return dict((dir_path, tuple(row for _, row in sorted(rows.items())))
+                    for dir_path, rows in read_folders.items())
+
+    def load(self):
+        """
+        Walks whole library. Already known files are not read again.
+        """
+        folders = [(self._dir_path(dir_path), files) for dir_path, files in walk_folders(self.input_path)]
+        read_folders = self._read(folders)
+        with self._lock:
+            self._folders = read_folders
+
+    def refresh(self, dir_paths):
+        """
+        Rescans given directories (relative to input_path). Directories which don't exist anymore
+        are removed with their sub directories, new sub directories are walked.
+        """
+        folders = []
+        removed_dirs = []
+        for dir_path in set(self._dir_path(os.path.join(self.input_path, path)) for path in dir_paths):
+            full_dir_path = os.path.join(self.input_path, dir_path)
+            try:
+                files, sub_dirs = scan_folder(full_dir_path)
+            except OSError:
+                removed_dirs.append(dir_path)
+                continue
+            folders.append((dir_path, files))
+            for sub_dir in sub_dirs:
+                sub_dir_path = self._dir_path(sub_dir)
+                if sub_dir_path not in self._folders:
+                    folders.extend((self._dir_path(path), sub_files) for path, sub_files in walk_folders(sub_dir))
+
+        read_folders = self._read(folders)
+        with self._lock:
+            folders = dict(self._folders)
+            for removed_dir in removed_dirs:
+                prefix = removed_dir + os.sep
+                for dir_path in [path for path in folders if path == removed_dir or path.startswith(prefix)]:
+                    del folders[dir_path]
+            for dir_path, rows in read_folders.items():
+                if rows:
+                    folders[dir_path] = rows
+                else:
+                    folders.pop(dir_path, None)
+            self._folders = folders
+
+    def changed_dirs(self):
+        """
+        Walks library comparing files modification time and size with model, tags are not read.
+
+        Output: dir_paths of directories which files were added, removed or changed, or which were removed.
+        """
+        folders = self._folders
+        walked_dirs = set()
+        changed_dirs = []
+        for dir_path, files in walk_folders(self.input_path):
+            dir_path = self._dir_path(dir_path)
+            walked_dirs.add(dir_path)
+            known_files = [(file_name, key) for file_name, key, _, _ in folders.get(dir_path, ())]
+            if known_files != [(file_name, stat_key(stat) if stat is not None else None) for file_name, stat in files]:
+                changed_dirs.append(dir_path)
+        changed_dirs.extend(sorted(set(folders) - walked_dirs))
+        return changed_dirs
+
+    def folder_dirs(self):
+        return sorted(self._folders)
+
+    def folder_files(self, dir_path, after=None, limit=None):
+        """
+        Files are ordered by name. When after file name is given, only following files are returned.
+
+        Output: [(file_path, values_dict, error)] with file_path relative to input_path
+        """
+        dir_path = self._dir_path(os.path.join(self.input_path, dir_path))
+        rows = self._folders.get(dir_path, ())
+        if after is not None:
+            rows = rows[bisect.bisect_right([row[0] for row in rows], after):]
+        if limit is not None:
+            rows = rows[:limit]
+        return [
+            (os.path.normpath(os.path.join(dir_path, file_name)), dict(zip(ID3_TAGS, values or [''] * len(ID3_TAGS))),
+             error)
+            for file_name, _, values, error in rows
+        ]
+
+    def folder_etag(self, dir_path, *extra):
+        """
+        Changes whenever directory file is added, removed or modified. extra values, e.g. request
+        parameters, are included too.
+        """
+        dir_path = self._dir_path(os.path.join(self.input_path, dir_path))
+        files = [(file_name, key) for file_name, key, _, _ in self._folders.get(dir_path, ())]
+        return hashlib.sha1(repr((dir_path, files, extra)).encode('utf8')).hexdigest()
+
+    def iter_folders_files(self):
+        """
+        Output: (dir_path, file_names[]) of all directories, tags are not used.
+        """
+        folders = self._folders
+        for dir_path in sorted(folders):
+            yield dir_path, [row[0] for row in folders[dir_path]]
+
+    def iter_folders_values(self, dir_paths=None):
+        """
+        Same output as iter_folders_id3_values, for all or given directories (relative to input_path).
+        """
+        folders = self._folders
+        if dir_paths is None:
+            dir_paths = sorted(folders)
+        else:
+            dir_paths = [self._dir_path(os.path.join(self.input_path, dir_path)) for dir_path in dir_paths]
+        for dir_path in dir_paths:
+            rows = folders.get(dir_path)
+            if rows:
+                yield dir_path, [(file_name, list(values or [''] * len(ID3_TAGS)), error)
+                                 for file_name, _, values, error in rows]
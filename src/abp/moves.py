@@ -0,0 +1,113 @@
+"""
+File moves used by apply_renames.
+
+Within one filesystem file is just renamed. Across filesystems (EXDEV) it's copied to unique temporary file next to
+target, fsynced, verified by comparing content hash with source, renamed into place and only then source is removed. So failure at any point
+leaves either source file or both complete files, never half-moved one.
+"""
+import os
+import errno
+import shutil
+import hashlib
+import tempfile
+
+
+COPY_BUFFER_SIZE = 1024 * 1024
+TMP_FILE_SUFFIX = '.abp-tmp'
+
+
+def _fast_copy(src_fd, dst_fd, size):
+    """
+    Copies data in kernel with copy_file_range or sendfile, when available (Python 3 on Linux).
+    Returns False when none of them can be used, so nothing was copied.
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+
+    for method in (copy_file_range, sendfile):
+        if method is None:
+            continue
+        offset = 0
+        try:
+            while offset < size:
+                if method is copy_file_range:
+                    copied = copy_file_range(src_fd, dst_fd, min(size - offset, COPY_BUFFER_SIZE * 64))
+                else:
+                    copied = sendfile(dst_fd, src_fd, offset, min(size - offset, COPY_BUFFER_SIZE * 64))
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            if offset:
+                raise
+            continue
+        if offset == size:
+            return True
+        raise IOError('Source file changed during copy')
+    return False
+
+
+def _fsync_dir(dir_path):
+    try:
+        fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:
+        return  # e.g. Windows, where directories can't be opened
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(COPY_BUFFER_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_file(src, dst):
+    """
+    Copies file data and stat (e.g. modification time), checks copied size, fsyncs it and compares content hash
+    of both files. Raises IOError when copy differs from source.
+    """
+    with open(src, 'rb', 0) as src_fp, open(dst, 'wb', 0) as dst_fp:
+        size = os.fstat(src_fp.fileno()).st_size
+        if not _fast_copy(src_fp.fileno(), dst_fp.fileno(), size):
+            shutil.copyfileobj(src_fp, dst_fp, COPY_BUFFER_SIZE)
+        copied_size = os.fstat(dst_fp.fileno()).st_size
+        if copied_size != size:
+            raise IOError('Copied %d bytes of %d to %s' % (copied_size, size, dst))
+        os.fsync(dst_fp.fileno())
+    if file_hash(src) != file_hash(dst):
+        raise IOError('Content of %s differs from %s' % (dst, src))
+    shutil.copystat(src, dst)
+
+
+def move_file(src, dst):
+    """
+    Returns True when file had to be copied, as target is on another filesystem.
+    """
+    try:
+        os.rename(src, dst)
+        return False
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    # unique name, so parallel moves to the same target don't write into one temporary file
+    fd, tmp_dst = tempfile.mkstemp(suffix=TMP_FILE_SUFFIX, prefix='.%s.' % os.path.basename(dst),
+                                   dir=os.path.dirname(dst) or '.')
+    os.close(fd)
+    try:
+        copy_file(src, tmp_dst)
+        os.rename(tmp_dst, dst)
+    except BaseException:
+        if os.path.exists(tmp_dst):
+            os.remove(tmp_dst)
+        raise
+    _fsync_dir(os.path.dirname(dst) or '.')
+    os.remove(src)
+    return True
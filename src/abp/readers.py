@@ -0,0 +1,443 @@
+"""
+Header-only tag readers.
+
+They read only tag headers and frames needed for ID3_TAGS, skipping audio data, which eyeD3 parses on load.
+Returned raw values are the same as eyeD3 tag attributes: track_num is (number, total) tuple, other tags are text.
+
+Besides ID3 (MP3) there are readers of Vorbis comments stored in FLAC metadata blocks and Ogg Vorbis / Opus
+comment headers, and of iTunes metadata atoms of MP4 (M4A) files.
+"""
+import io
+import struct
+
+import six
+
+from abp import stats
+
+
+ID3V1_SIZE = 128
+ID3V2_HEADER_SIZE = 10
+
+ID3V2_FRAMES = {
+    2: {b'TRK': 'track_num', b'TT2': 'title', b'TP1': 'artist', b'TAL': 'album'},
+    3: {b'TRCK': 'track_num', b'TIT2': 'title', b'TPE1': 'artist', b'TALB': 'album'},
+    4: {b'TRCK': 'track_num', b'TIT2': 'title', b'TPE1': 'artist', b'TALB': 'album'},
+}
+ID3V2_TEXT_ENCODINGS = ['latin_1', 'utf_16', 'utf_16_be', 'utf_8']
+ID3V1_STRIP_CHARS = b' \t\n\r\x0b\x0c\x00'
+
+FLAC_MAGIC = b'fLaC'
+FLAC_VORBIS_COMMENT_BLOCK = 4
+OGG_MAGIC = b'OggS'
+OGG_PAGE_HEADER_SIZE = 27
+OGG_COMMENT_PACKET_PREFIXES = [b'\x03vorbis', b'OpusTags']
+# Comment packet is usually in second page, bigger ones (e.g. with embedded cover) are not read
+OGG_MAX_PACKET_SIZE = 16 * 1024 * 1024
+VORBIS_COMMENTS = {'TRACKNUMBER': 'track_num', 'TITLE': 'title', 'ARTIST': 'artist', 'ALBUM': 'album'}
+VORBIS_TRACK_TOTALS = ('TRACKTOTAL', 'TOTALTRACKS')
+MP4_MAGIC = b'ftyp'  # at offset 4
+MP4_ITEMS = {b'trkn': 'track_num', b'\xa9nam': 'title', b'\xa9ART': 'artist', b'\xa9alb': 'album'}
+MP4_CONTAINER_PATH = [b'moov', b'udta', b'meta', b'ilst']
+
+
+class TagReaderError(Exception):
+    """
+    Tag uses feature not supported by header-only reader (or is broken), full parser should be used.
+    """
+
+
+class ID3ReaderError(TagReaderError):
+    pass
+
+
+def _syncsafe_int(data):
+    value = 0
+    for byte in bytearray(data):
+        value = (value << 7) | (byte & 0x7f)
+    return value
+
+
+def _int(data):
+    value = 0
+    for byte in bytearray(data):
+        value = (value << 8) | byte
+    return value
+
+
+def _resync(data):
+    return data.replace(b'\xff\x00', b'\xff')
+
+
+def _read(fp, size):
+    data = fp.read(size)
+    if len(data) != size:
+        raise ID3ReaderError('Unexpected end of file')
+    return data
+
+
+def _decode_text_frame(data):
+    if not data:
+        return u''
+    encoding = six.indexbytes(data, 0)
+    if encoding >= len(ID3V2_TEXT_ENCODINGS):
+        raise ID3ReaderError('Unknown text encoding %d' % encoding)
+    codec = ID3V2_TEXT_ENCODINGS[encoding]
+    text = data[1:]
+    if codec.startswith('utf_16') and len(text) % 2 != 0 and text[-1:] == b'\x00':
+        text = text[:-1]
+    try:
+        return text.decode(codec).rstrip(u'\x00')
+    except UnicodeDecodeError as e:
+        raise ID3ReaderError(str(e))
+
+
+def _split_num(text):
+    first, second = None, None
+    if text:
+        parts = text.split(u'/')
+        try:
+            first = int(parts[0])
+            second = int(parts[1]) if len(parts) == 2 else None
+        except ValueError:
+            pass
+    return first, second
+
+
+def _iter_id3v2_frames(fp, version, end):
+    """
+    Output: (frame_id, frame_flags, frame_data) of frames which values are needed.
+    """
+    wanted_frames = ID3V2_FRAMES[version]
+    id_size, header_size = (3, 6) if version == 2 else (4, 10)
+
+    while fp.tell() + header_size <= end:
+        header = _read(fp, header_size)
+        frame_id = header[:id_size]
+        if frame_id[:1] == b'\x00':
+            break  # padding
+        if version == 2:
+            frame_size, flags = _int(header[3:6]), 0
+        elif version == 3:
+            frame_size, flags = _int(header[4:8]), _int(header[8:10])
+        else:
+            frame_size, flags = _syncsafe_int(header[4:8]), _int(header[8:10])
+
+        if fp.tell() + frame_size > end:
+            raise ID3ReaderError('Frame %r exceeds tag size' % frame_id)
+        if frame_id not in wanted_frames:
+            fp.seek(frame_size, io.SEEK_CUR)
+            continue
+        yield frame_id, flags, _read(fp, frame_size)
+
+
+def _frame_data(version, flags, data):
+    if version == 3:
+        if flags & 0x00c0:
+            raise ID3ReaderError('Compressed or encrypted frame')
+        if flags & 0x0020:
+            data = data[1:]  # group id
+    elif version == 4:
+        if flags & 0x000c:
+            raise ID3ReaderError('Compressed or encrypted frame')
+        if flags & 0x0040:
+            data = data[1:]  # group id
+        if flags & 0x0001:
+            data = data[4:]  # data length indicator
+        if flags & 0x0002:
+            data = _resync(data)
+    return data
+
+
+def read_id3v2_tags(fp):
+    """
+    Returns raw values of ID3v2 tag located at beginning of file or None when there is no such tag.
+    """
+    fp.seek(0)
+    header = fp.read(ID3V2_HEADER_SIZE)
+    if len(header) != ID3V2_HEADER_SIZE or header[:3] != b'ID3':
+        return None
+
+    version = six.indexbytes(header, 3)
+    flags = six.indexbytes(header, 5)
+    tag_size = _syncsafe_int(header[6:10])
+    if version not in ID3V2_FRAMES:
+        raise ID3ReaderError('Unsupported ID3v2.%d tag' % version)
+    if version == 2 and flags & 0x40:
+        raise ID3ReaderError('Compressed ID3v2.2 tag')
+
+    end = ID3V2_HEADER_SIZE + tag_size
+    if flags & 0x80 and version < 4:
+        # Whole tag is unsynchronised, so frame sizes apply to resynchronised data.
+        data = _resync(_read(fp, tag_size))
+        fp = io.BytesIO(b'\x00' * ID3V2_HEADER_SIZE + data)
+        fp.seek(ID3V2_HEADER_SIZE)
+        end = ID3V2_HEADER_SIZE + len(data)
+
+    if flags & 0x40:
+        if version == 3:
+            fp.seek(_int(_read(fp, 4)), io.SEEK_CUR)
+        else:
+            fp.seek(_syncsafe_int(_read(fp, 4)) - 4, io.SEEK_CUR)
+
+    tags = {}
+    wanted_frames = ID3V2_FRAMES[version]
+    for frame_id, frame_flags, data in _iter_id3v2_frames(fp, version, end):
+        tag = wanted_frames[frame_id]
+        if tag in tags:
+            continue
+        text = _decode_text_frame(_frame_data(version, frame_flags, data))
+        tags[tag] = _split_num(text) if tag == 'track_num' else text
+    return tags
+
+
+def read_id3v1_tags(fp):
+    """
+    Returns raw values of ID3v1 tag located at end of file or None when there is no such tag.
+    """
+    fp.seek(0, io.SEEK_END)
+    if fp.tell() < ID3V1_SIZE:
+        return None
+    fp.seek(-ID3V1_SIZE, io.SEEK_END)
+    data = fp.read(ID3V1_SIZE)
+    if data[:3] != b'TAG':
+        return None
+
+    tags = {}
+    for tag, start, end in (('title', 3, 33), ('artist', 33, 63), ('album', 63, 93)):
+        value = data[start:end].strip(ID3V1_STRIP_CHARS)
+        if value:
+            tags[tag] = value.decode('latin_1')
+
+    comment = data[97:127].rstrip(b'\x00')
+    if len(comment) >= 2 and comment[-2:-1] == b'\x00' and comment[-1:] != b'\x00':
+        tags['track_num'] = (six.indexbytes(comment, len(comment) - 1), None)
+    return tags
+
+
+def _open_counted(file_path):
+    fp = open(file_path, 'rb')
+    if stats.enabled():
+        fp = stats.CountingFile(fp)
+    return fp
+
+
+def _close_counted(fp):
+    stats.incr('bytes_read', getattr(fp, 'bytes_read', 0))
+    fp.close()
+
+
+def is_mp3_header(header):
+    if header[:3] == b'ID3':
+        return True
+    return len(header) > 1 and header[:1] == b'\xff' and six.indexbytes(header, 1) & 0xe0 == 0xe0  # frame sync
+
+
+def read_id3_tags(file_path):
+    """
+    Returns raw values of ID3v2 tag, or ID3v1 one when file has no ID3v2 tag.
+    Raises ID3ReaderError when tag can't be read without full parser, or file doesn't start like MP3,
+    so other format with wrong extension isn't taken for MP3 without tags.
+    """
+    fp = _open_counted(file_path)
+    try:
+        tags = read_id3v2_tags(fp)
+        if tags is None:
+            fp.seek(0)
+            if not is_mp3_header(fp.read(ID3V2_HEADER_SIZE)):
+                raise ID3ReaderError('Not an MP3 file')
+            tags = read_id3v1_tags(fp)
+    finally:
+        _close_counted(fp)
+    return tags or {}
+
+
+def _skip_id3v2_tag(fp):
+    """
+    FLAC files are sometimes prefixed with ID3v2 tag, it's skipped.
+    """
+    fp.seek(0)
+    header = fp.read(ID3V2_HEADER_SIZE)
+    if header[:3] == b'ID3' and len(header) == ID3V2_HEADER_SIZE:
+        fp.seek(ID3V2_HEADER_SIZE + _syncsafe_int(header[6:10]) + (10 if six.indexbytes(header, 5) & 0x10 else 0))
+    else:
+        fp.seek(0)
+
+
+def parse_vorbis_comment(data):
+    """
+    Returns raw values of Vorbis comment block (without framing bit), as used by FLAC and Ogg.
+    """
+    try:
+        offset = 4 + struct.unpack('<I', data[:4])[0]  # vendor string
+        count = struct.unpack('<I', data[offset:offset + 4])[0]
+        offset += 4
+        comments = {}
+        for _ in range(count):
+            length = struct.unpack('<I', data[offset:offset + 4])[0]
+            comment = data[offset + 4:offset + 4 + length]
+            offset += 4 + length
+            if len(comment) != length:
+                raise TagReaderError('Unexpected end of Vorbis comment')
+            name, _, value = comment.partition(b'=')
+            comments.setdefault(name.decode('ascii', 'replace').upper(), value.decode('utf8'))
+    except (struct.error, UnicodeDecodeError) as e:
+        raise TagReaderError('Broken Vorbis comment - %s' % e)
+
+    tags = {}
+    for name, tag in VORBIS_COMMENTS.items():
+        if name in comments:
+            tags[tag] = comments[name]
+    if 'track_num' in tags:
+        number, total = _split_num(tags['track_num'])
+        if total is None:
+            total = next((_split_num(comments[name])[0] for name in VORBIS_TRACK_TOTALS if name in comments), None)
+        tags['track_num'] = (number, total)
+    return tags
+
+
+def read_flac_tags(file_path):
+    """
+    Returns raw values of Vorbis comment metadata block, other blocks and audio frames are skipped.
+    """
+    fp = _open_counted(file_path)
+    try:
+        _skip_id3v2_tag(fp)
+        if fp.read(4) != FLAC_MAGIC:
+            raise TagReaderError('Not a FLAC file')
+        while True:
+            header = _read(fp, 4)
+            block_type = six.indexbytes(header, 0) & 0x7f
+            block_size = _int(header[1:])
+            if block_type == FLAC_VORBIS_COMMENT_BLOCK:
+                return parse_vorbis_comment(_read(fp, block_size))
+            if six.indexbytes(header, 0) & 0x80:
+                return {}  # last metadata block
+            fp.seek(block_size, io.SEEK_CUR)
+    except ID3ReaderError as e:
+        raise TagReaderError(str(e))
+    finally:
+        _close_counted(fp)
+
+
+def _iter_ogg_packets(fp):
+    """
+    Yields packets of first logical stream, reading pages only as far as packets are requested.
+    """
+    packet = []
+    packet_size = 0
+    serial = None
+    while True:
+        header = fp.read(OGG_PAGE_HEADER_SIZE)
+        if len(header) < OGG_PAGE_HEADER_SIZE:
+            return
+        if header[:4] != OGG_MAGIC:
+            raise TagReaderError('Broken Ogg page')
+        page_serial = header[14:18]
+        segment_sizes = bytearray(_read(fp, six.indexbytes(header, 26)))
+        if serial is None:
+            serial = page_serial
+        elif page_serial != serial:
+            fp.seek(sum(segment_sizes), io.SEEK_CUR)
+            continue
+        for segment_size in segment_sizes:
+            packet.append(_read(fp, segment_size))
+            packet_size += segment_size
+            if packet_size > OGG_MAX_PACKET_SIZE:
+                raise TagReaderError('Ogg packet too big')
+            if segment_size < 255:
+                yield b''.join(packet)
+                packet = []
+                packet_size = 0
+
+
+def read_ogg_tags(file_path):
+    """
+    Returns raw values of comment header, the second packet of Ogg Vorbis or Opus stream.
+    """
+    fp = _open_counted(file_path)
+    try:
+        packets = _iter_ogg_packets(fp)
+        for i, packet in enumerate(packets):
+            if i == 0:
+                continue  # identification header
+            for prefix in OGG_COMMENT_PACKET_PREFIXES:
+                if packet.startswith(prefix):
+                    return parse_vorbis_comment(packet[len(prefix):])
+            raise TagReaderError('Unsupported Ogg stream')
+        return {}
+    except ID3ReaderError as e:
+        raise TagReaderError(str(e))
+    finally:
+        _close_counted(fp)
+
+
+def _iter_mp4_atoms(fp, end):
+    """
+    Output: (atom_type, data_start, atom_end)
+    """
+    while fp.tell() + 8 <= end:
+        start = fp.tell()
+        size, atom_type = struct.unpack('>I4s', _read(fp, 8))
+        if size == 1:
+            size = struct.unpack('>Q', _read(fp, 8))[0]
+        elif size == 0:
+            size = end - start
+        if size < 8 or start + size > end:
+            raise TagReaderError('Broken MP4 atom %r' % atom_type)
+        yield atom_type, fp.tell(), start + size
+        fp.seek(start + size)
+
+
+def _mp4_item_value(tag, fp, start, end):
+    fp.seek(start)
+    for atom_type, data_start, data_end in _iter_mp4_atoms(fp, end):
+        if atom_type != b'data':
+            continue
+        fp.seek(data_start)
+        data = _read(fp, data_end - data_start)[8:]  # type indicator and locale
+        if tag == 'track_num':
+            if len(data) < 6:
+                raise TagReaderError('Broken MP4 track number')
+            number, total = struct.unpack('>HH', data[2:6])
+            return number or None, total or None
+        try:
+            return data.decode('utf8')
+        except UnicodeDecodeError as e:
+            raise TagReaderError(str(e))
+    return None
+
+
+def read_mp4_tags(file_path):
+    """
+    Returns raw values of iTunes metadata items (moov.udta.meta.ilst), media data atoms are skipped.
+    """
+    fp = _open_counted(file_path)
+    try:
+        fp.seek(0, io.SEEK_END)
+        end = fp.tell()
+        fp.seek(0)
+        header = fp.read(8)
+        if header[4:8] != MP4_MAGIC:
+            raise TagReaderError('Not a MP4 file')
+        fp.seek(0)
+        for container in MP4_CONTAINER_PATH:
+            for atom_type, start, atom_end in _iter_mp4_atoms(fp, end):
+                if atom_type == container:
+                    fp.seek(start + 4 if container == b'meta' else start)  # meta has version and flags
+                    end = atom_end
+                    break
+            else:
+                return {}
+
+        tags = {}
+        for atom_type, start, atom_end in list(_iter_mp4_atoms(fp, end)):
+            tag = MP4_ITEMS.get(atom_type)
+            if tag is not None and tag not in tags:
+                value = _mp4_item_value(tag, fp, start, atom_end)
+                if value is not None:
+                    tags[tag] = value
+        return tags
+    except ID3ReaderError as e:
+        raise TagReaderError(str(e))
+    finally:
+        _close_counted(fp)
@@ -4,6 +4,8 @@ $(function() {
     Handlebars.registerPartial("FolderDetailsRow", $('#folder-details-template').html());
 
     var FOLDER_DETAILS_CACHE = {};
+    var MATCHED_STREAM = null;
+    var ID3_LIST_PAGE_SIZE = 500;
 
     String.prototype.replaceBetween= function(replace, start, end) {
         return this.substring(0, start) + replace + this.substring(end);
@@ -37,6 +39,54 @@ $(function() {
         $('#preview-values').addClass('active')
     };
 
+    var abort_matched_stream = function() {
+        if (MATCHED_STREAM) {
+            MATCHED_STREAM.abort();
+            MATCHED_STREAM = null;
+        }
+    };
+
+    // Reads NDJSON response, on_item is called for each line as soon as it's received.
+    // Previous stream is aborted, so server stops processing it.
+    var stream_json_lines = function(url, on_item) {
+        abort_matched_stream();
+        var controller = new AbortController(),
+            decoder = new TextDecoder(),
+            buffer = '';
+        MATCHED_STREAM = controller;
+
+        fetch(url, {'signal': controller.signal})
+            .then(function(response) {
+                var reader = response.body.getReader();
+                var read = function() {
+                    return reader.read().then(function(result) {
+                        buffer += decoder.decode(result.value || new Uint8Array(), {'stream': !result.done});
+                        var lines = buffer.split('\n');
+                        buffer = lines.pop();
+                        for (var i=0; i < lines.length; i++) {
+                            if (lines[i]) {
+                                on_item(JSON.parse(lines[i]));
+                            }
+                        }
+                        if (result.done) {
+                            if (MATCHED_STREAM === controller) {
+                                MATCHED_STREAM = null;
+                            }
+                            return;
+                        }
+                        return read();
+                    });
+                };
+                return read();
+            })
+            .catch(function(error) {
+                if (error.name !== 'AbortError') {
+                    throw error;
+                }
+            });
+        return controller;
+    };
+
     var get_pattern_groups = function(pattern) {
         var group_regex = /\?P\<([^\>]+)\>/,
             group_regex_global = /\?P\<([^\>]+)\>/g;
@@ -58,6 +108,40 @@ $(function() {
         folder_details.data('loaded', 1);
     };
 
+    var prepare_item = function(item) {
+        if (item.matched_pattern) {
+            var file = item.file;
+            for (var i = item.matched_groups.length - 1; i >= 0; i--) {
+                var matched_group = item.matched_groups[i],
+                    field_name = matched_group[0],
+                    span_start = matched_group[1],
+                    span_end = matched_group[2],
+                    field_value = file.substring(span_start, span_end);
+
+                new_field_value = '<u title="' + field_name + '">' + field_value + '</u>'
+                file = file.replaceBetween(new_field_value,  span_start, span_end);
+            }
+            item.file = file;
+        }
+
+        if (item.id3_preview) {
+            keys = Object.keys(item.id3);
+            for (var i=0; i < keys.length; i++) {
+                var key = keys[i];
+                if (item.id3[key] == item.id3_preview[key]) {
+                    delete item.id3_preview[key];
+                }
+            }
+        }
+
+        if (item.file_preview) {
+            if (item.file == item.file_preview) {
+                delete item.file_preview;
+            }
+        }
+        return item;
+    };
+
     var load_folder_details = function(folder_details) {
         var path = folder_details.data('path');
         var form = [{'name': 'path', 'value': path}];
@@ -73,44 +157,27 @@ $(function() {
 
         var active_tab = $('#mode-form button[aria-expanded=true]').prop('id');
 
-        $.ajax('/api/id3-list?' + $.param(form))
-            .done(function(data) {
-                data = data.map(function(item) {
-                    if (item.matched_pattern) {
-                        var file = item.file;
-                        for (var i = item.matched_groups.length - 1; i >= 0; i--) {
-                            var matched_group = item.matched_groups[i],
-                                field_name = matched_group[0],
-                                span_start = matched_group[1],
-                                span_end = matched_group[2],
-                                field_value = file.substring(span_start, span_end);
-
-                            new_field_value = '<u title="' + field_name + '">' + field_value + '</u>'
-                            file = file.replaceBetween(new_field_value,  span_start, span_end);
-                        }
-                        item.file = file;
-                    }
-
-                    if (item.id3_preview) {
-                        keys = Object.keys(item.id3);
-                        for (var i=0; i < keys.length; i++) {
-                            var key = keys[i];
-                            if (item.id3[key] == item.id3_preview[key]) {
-                                delete item.id3_preview[key];
-                            }
-                        }
-                    }
-
-                    if (item.file_preview) {
-                        if (item.file == item.file_preview) {
-                            delete item.file_preview;
-                        }
+        var files = [];
+        // Files are loaded page by page, rows are rendered as soon as page arrives.
+        var load_page = function(cursor) {
+            var page_form = form.concat([{'name': 'limit', 'value': ID3_LIST_PAGE_SIZE}]);
+            if (cursor) {
+                page_form.push({'name': 'cursor', 'value': cursor});
+            }
+            $.ajax('/api/id3-list?' + $.param(page_form))
+                .done(function(data, status, xhr) {
+                    files = files.concat(data.map(prepare_item));
+                    var next_cursor = xhr.getResponseHeader('X-Next-Cursor');
+                    if (next_cursor) {
+                        load_folder_details_action(folder_details, files);
+                        load_page(next_cursor);
+                    } else {
+                        FOLDER_DETAILS_CACHE[path] = files;
+                        load_folder_details_action(folder_details, files);
                     }
-                    return item;
                 });
-                FOLDER_DETAILS_CACHE[path] = data;
-                load_folder_details_action(folder_details, data);
-            });
+        };
+        load_page(null);
     };
 
     var expand_folder_action = function(folder_details) {
@@ -122,6 +189,7 @@ $(function() {
     };
 
     var load_list = function() {
+        abort_matched_stream();
         clean_expansions();
 
         $('.folder-select:checked').prop('checked', '')
@@ -197,29 +265,26 @@ $(function() {
                         not_selected = data.slice();
                         redraw();
                     } else if (action === 'select-matched') {
-                        if (mode == 'id3') {
-                            var form = $('#preview-values').data('form');
-                            $.ajax('/api/matched-folders?' + $.param(form))
-                                .done(function(matched) {
-                                    selected = [];
-                                    not_selected = data.slice();
-                                    for (var i=0; i < matched.length; i++) {
-                                        select_item(matched[i])
-                                    }
-                                    redraw();
-                                });
-                        } else if (mode == 'rename') {
-                            var form = $('#preview-values').data('form');
-                            $.ajax('/api/matched-renames?' + $.param(form))
-                                .done(function(matched) {
-                                    selected = [];
-                                    not_selected = data.slice();
-                                    for (var i=0; i < matched.length; i++) {
-                                        select_item(matched[i])
+                        var form = $('#preview-values').data('form');
+                        var url = mode == 'id3' ? '/api/matched-folders?' : '/api/matched-renames?';
+                        var redraw_pending = false;
+                        selected = [];
+                        not_selected = data.slice();
+                        redraw();
+
+                        // matched folders are selected as they come, redrawn at most once per frame
+                        var stream = stream_json_lines(url + $.param(form), function(matched) {
+                            select_item(matched);
+                            if (!redraw_pending) {
+                                redraw_pending = true;
+                                window.requestAnimationFrame(function() {
+                                    redraw_pending = false;
+                                    if (!stream.signal.aborted) {
+                                        redraw();
                                     }
-                                    redraw();
                                 });
-                        }
+                            }
+                        });
                     }
                 });
             })
@@ -235,6 +300,7 @@ $(function() {
     });
 
     $('#preview-changes').click(function() {
+        abort_matched_stream();
         clean_expansions();
         prepare_form_values();
         $('body').addClass('preview')
@@ -243,6 +309,40 @@ $(function() {
         });
     });
 
+    var JOB_POLL_INTERVAL = 500;
+
+    var show_job_progress = function(job) {
+        var text = job.name + ': ' + job.status + ', ' + job.done + (job.total === null ? '' : ' / ' + job.total) +
+                   ' files, ' + job.throughput.toFixed(1) + ' files/s';
+        if (job.errors.length) {
+            text += ', ' + job.errors.length + ' errors';
+        }
+        if (job.error) {
+            text += ' - ' + job.error;
+        }
+        $('#job-progress .status').text(text);
+        $('#job-progress').data('job', job.id).show();
+        $('#cancel-job').toggle(job.status == 'pending' || job.status == 'running');
+    };
+
+    // Polls job until it's finished, then on_finished is called.
+    var wait_for_job = function(job, on_finished) {
+        show_job_progress(job);
+        if (job.status == 'pending' || job.status == 'running') {
+            setTimeout(function() {
+                $.ajax('/api/jobs/' + job.id).done(function(job) {
+                    wait_for_job(job, on_finished);
+                });
+            }, JOB_POLL_INTERVAL);
+        } else {
+            on_finished(job);
+        }
+    };
+
+    $('#cancel-job').click(function() {
+        $.ajax('/api/jobs/' + $('#job-progress').data('job') + '/cancel', {'method': 'POST'});
+    });
+
     $('#apply-changes').click(function() {
         var form = $('#preview-values').data('form');
         var selected_folders = $('#folders-selected .folder-details');
@@ -251,29 +351,19 @@ $(function() {
             form.push({name: 'folder-path', value: $(selected_folders[i]).data('path')})
         }
 
-        if (mode == 'id3') {
-            $.ajax('/api/apply', {
-                'method': 'POST',
-                'data': $.param(form),
-            }).done(function() {
+        var url = mode == 'id3' ? '/api/apply' : '/api/apply-renames';
+        $.ajax(url, {
+            'method': 'POST',
+            'data': $.param(form),
+        }).done(function(job) {
+            wait_for_job(job, function() {
                 $('body').addClass('preview')
                 $('.folder-details.active').each(function(index, item) {
                     load_folder_details($(item));
                 });
                 load_list();
             });
-        } else if (mode == 'rename') {
-            $.ajax('/api/apply-renames', {
-                'method': 'POST',
-                'data': $.param(form),
-            }).done(function() {
-                $('body').addClass('preview')
-                $('.folder-details.active').each(function(index, item) {
-                    load_folder_details($(item));
-                });
-                load_list();
-            });
-        }
+        });
     });
 
 })
\ No newline at end of file
@@ -0,0 +1,169 @@
+"""
+Opt-in instrumentation of processing phases.
+
+Collection is disabled by default and recording functions return immediately then. When enabled,
+counters (e.g. files scanned, bytes read) and latency histograms of phases (walk, read, match, normalize,
+write, rename) with slowest items are kept in memory and reported as dict.
+
+Only calls made in this process are recorded, so work done by process executor workers is not included.
+"""
+import time
+import heapq
+import threading
+import contextlib
+from timeit import default_timer
+
+
+# Histogram bucket upper bounds in milliseconds
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf')]
+SLOWEST_ITEMS = 10
+
+
+class Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * len(BUCKETS)
+        self.slowest = []  # heap of (seconds, item)
+
+    def add(self, seconds, item=None):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        milliseconds = seconds * 1000
+        for i, bound in enumerate(BUCKETS):
+            if milliseconds <= bound:
+                self.buckets[i] += 1
+                break
+        if item is not None:
+            if len(self.slowest) < SLOWEST_ITEMS:
+                heapq.heappush(self.slowest, (seconds, item))
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, item))
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'min': self.min,
+            'max': self.max,
+            'buckets': [['+Inf' if bound == float('inf') else bound, count]
+                        for bound, count in zip(BUCKETS, self.buckets)],
+            'slowest': [[item, seconds] for seconds, item in sorted(self.slowest, reverse=True)],
+        }
+
+
+class Stats(object):
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, phase, seconds, item=None):
+        with self._lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = Histogram()
+            histogram.add(seconds, item)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'enabled': True,
+                'elapsed': time.time() - self.started,
+                'counters': dict(self.counters),
+                'phases': dict((phase, histogram.to_dict()) for phase, histogram in self.histograms.items()),
+            }
+
+
+_stats = None
+
+
+def enable():
+    """
+    Starts collection, previously collected values are dropped.
+    """
+    global _stats
+    _stats = Stats()
+    return _stats
+
+
+def disable():
+    global _stats
+    _stats = None
+
+
+def enabled():
+    return _stats is not None
+
+
+def incr(name, value=1):
+    if _stats is not None:
+        _stats.incr(name, value)
+
+
+class NullTimer(object):
+    """
+    Context manager doing nothing, shared by all timer calls while collection is disabled.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+def timer(phase, item=None):
+    """
+    Records duration of block, also when it raises. Nothing is created per call when collection is disabled,
+    as it's used on per file paths.
+    """
+    if _stats is None:
+        return NULL_TIMER
+    return _timer(_stats, phase, item)
+
+
+@contextlib.contextmanager
+def _timer(stats, phase, item):
+    started = default_timer()
+    try:
+        yield
+    finally:
+        stats.record(phase, default_timer() - started, item)
+
+
+def report():
+    if _stats is None:
+        return {'enabled': False}
+    return _stats.to_dict()
+
+
+class CountingFile(object):
+    """
+    File wrapper counting bytes returned by read.
+    """
+    def __init__(self, fp):
+        self._fp = fp
+        self.bytes_read = 0
+
+    def read(self, *args):
+        data = self._fp.read(*args)
+        self.bytes_read += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
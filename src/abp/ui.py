@@ -1,16 +1,67 @@
+import io
 import os
-import re
+import json
+import gzip
 
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, abort, render_template, jsonify, request
 
-from abp.core import (folder_id3_list, get_folder_dirs, get_file_id3_changes, get_id3_values_dict, prepare_id3_values_dict,
-                      get_id3_changes, apply_changes, get_rename, get_renames, apply_renames as core_apply_renames,
-                      is_rename_fully_matched)
-from abp.core import ID3_TAGS
+from abp.core import (get_file_id3_changes, prepare_id3_values_dict, get_id3_changes, apply_changes, get_rename,
+                      get_renames, apply_renames as core_apply_renames, match_pattern_folders, match_rename_folders)
+from abp.core import ID3_TAGS, PatternSet
+from abp.index import open_index
+from abp.jobs import JobQueue
+from abp.library import Library
+from abp.watch import start_watcher
+from abp import stats
 
+try:
+    import waitress
+except ImportError:
+    waitress = None
 
-def create_app(input_path):
+
+# Smaller responses aren't worth compressing.
+GZIP_MIN_SIZE = 1024
+
+
+def gzip_compress(data, compresslevel=6):
+    output = io.BytesIO()
+    with gzip.GzipFile(fileobj=output, mode='wb', compresslevel=compresslevel) as gzip_file:
+        gzip_file.write(data)
+    return output.getvalue()
+
+
+def create_app(input_path, watch=True, compress=True):
     app = Flask(__name__)
+    tag_index = open_index(input_path)
+    library = Library(input_path, index=tag_index)
+    library.load()
+    app.library = library
+    if watch:
+        app.watcher = start_watcher(library)
+    job_queue = app.job_queue = JobQueue()
+
+    @app.teardown_request
+    def commit_index(exception=None):
+        if tag_index is not None:
+            tag_index.commit()
+
+    @app.after_request
+    def gzip_response(response):
+        """
+        Compresses large buffered responses, e.g. /api/id3-list. Streamed ones and static files are sent as they are.
+        """
+        if (not compress or response.direct_passthrough or response.is_streamed or response.status_code != 200 or
+                'Content-Encoding' in response.headers or
+                'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+            return response
+        data = response.get_data()
+        if len(data) < GZIP_MIN_SIZE:
+            return response
+        response.set_data(gzip_compress(data))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        return response
 
     def validate_path(param_path):
         if os.path.relpath(param_path, input_path).startswith('..'):
@@ -26,68 +77,97 @@ def create_app(input_path):
 
     @app.route("/api/list")
     def list_():
-        return jsonify([clean_path(path) for path in get_folder_dirs(input_path)])
+        return jsonify(library.folder_dirs())
 
     @app.route("/api/id3-list")
     def id3():
-        folder_dir = request.args.get('path') 
+        """
+        Files are paginated when limit is given: next page cursor is sent in X-Next-Cursor header.
+        fields limits keys of returned items, e.g. fields=file,id3_preview.
+        ETag changes when any folder file changes, so unchanged folder is answered with 304.
+        """
+        folder_dir = request.args.get('path')
+        if folder_dir is None:
+            abort(400)
         folder_dir_path = os.path.realpath(os.path.join(input_path, folder_dir))
         validate_path(folder_dir_path)
+        limit = request.args.get('limit', type=int)
+        if limit is not None and limit < 1:
+            abort(400)
+
+        etag = library.folder_etag(folder_dir, request.query_string)
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+        fields = set(field for field in request.args.get('fields', '').split(',') if field)
+
+        def requested(*field_names):
+            return not fields or any(field_name in fields for field_name in field_names)
+
+        files = library.folder_files(folder_dir, after=request.args.get('cursor'), limit=limit + 1 if limit else None)
+        next_cursor = None
+        if limit and len(files) > limit:
+            files = files[:limit]
+            next_cursor = os.path.basename(files[-1][0])
 
         output = [
-            dict(item, file=clean_path(item['file']))
-            for item in folder_id3_list(folder_dir_path)
+            {'file': file_path, 'id3': id3_values}
+            for file_path, id3_values, _ in files
         ]
         mode = request.args.get('mode')
-        if mode == 'id3':
-            patterns = [re.compile(pattern.strip()) for pattern in request.args.get('patterns').split('\n') if pattern]
+        if mode == 'id3' and requested('id3_preview', 'matched_pattern', 'matched_groups'):
+            patterns = PatternSet(pattern.strip() for pattern in request.args.get('patterns').split('\n') if pattern)
+            folder_cache = {}
             for item in output:
                 id3_values = [item['id3'][tag] for tag in ID3_TAGS]
                 matched_pattern, matched_groups, id3_changes = get_file_id3_changes(
                     id3_values, item['file'], patterns,
                     request.args.get('asciify') == 'on',
-                    request.args.get('unescape') == 'on'
+                    request.args.get('unescape') == 'on',
+                    folder_cache
                 )
                 item['id3_preview'] = prepare_id3_values_dict(id3_changes)
                 item['matched_pattern'] = matched_pattern
                 item['matched_groups'] = matched_groups
-        elif mode == 'rename':
+        elif mode == 'rename' and requested('file_preview'):
             pattern = request.args.get('pattern')
             for item in output:
-                item['file_preview'] = get_rename(pattern, item['id3'])
+                item['file_preview'] = get_rename(pattern, dict(item['id3'], ext=os.path.splitext(item['file'])[1][1:]))
             # for item in output:
-        return jsonify(output)
+        if fields:
+            output = [dict((key, value) for key, value in item.items() if key in fields) for item in output]
+
+        response = jsonify(output)
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+
+    def stream_json_lines(items):
+        """
+        NDJSON response, each item is sent as soon as it's yielded.
+        When client cancels request, generator is closed on next write and processing stops.
+        """
+        return Response((json.dumps(item) + '\n' for item in items), mimetype='application/x-ndjson')
 
     @app.route("/api/matched-folders")
     def matched_folders():
-        matched_folders = set()
-        patterns = [re.compile(pattern.strip()) for pattern in request.args.get('patterns').split('\n') if pattern]
-
-        for folder_path in get_folder_dirs(input_path):
-            files = [clean_path(item['file']) for item in folder_id3_list(folder_path)]
-            for file in files:
-                id3_values = [item['id3'][tag] for tag in ID3_TAGS]
-                matched_pattern, matched_groups, id3_changes = get_file_id3_changes({}, file, patterns, False, False)
-                if matched_pattern:
-                    matched_folders.add(clean_path(folder_path))
-                    break
-        return jsonify(list(matched_folders))
+        patterns = PatternSet(pattern.strip() for pattern in request.args.get('patterns').split('\n') if pattern)
+        return stream_json_lines(match_pattern_folders(input_path, patterns, folders=library.iter_folders_files()))
 
     @app.route("/api/matched-renames")
     def matched_renames():
-        matched_folders = set()
         pattern = request.args.get('pattern')
-
-        for folder_path in get_folder_dirs(input_path):
-            files = [clean_path(item['file']) for item in folder_id3_list(folder_path)]
-            if all(is_rename_fully_matched(pattern, get_id3_values_dict(os.path.join(input_path, file)), file) for file in files):
-                matched_folders.add(clean_path(folder_path))
-        return jsonify(list(matched_folders))
+        return stream_json_lines(match_rename_folders(input_path, pattern,
+                                                      folders_values=library.iter_folders_values()))
 
     @app.route("/api/apply", methods=['POST'])
     def apply():
-        patterns = [re.compile(pattern.strip()) for pattern in request.form.get('patterns').split('\n') if pattern]
-        asciify = request.form.get('asciify') == 'on',
+        patterns = PatternSet(pattern.strip() for pattern in request.form.get('patterns').split('\n') if pattern)
+        asciify = request.form.get('asciify') == 'on'
         unescape = request.form.get('unescape') == 'on'
         encoding = request.form.get('encoding')
         folder_dirs = request.form.getlist('folder-path')
@@ -97,10 +177,19 @@ def create_app(input_path):
         for folder_dir_path in folder_dir_paths:
             validate_path(folder_dir_path)
 
-        all_changes, ignored_files = get_id3_changes(input_path, empty_override=False, file_patterns=patterns,
-                                                     asciify=asciify, unescape=unescape, folder_dirs=folder_dirs)
-        changed_files = apply_changes(all_changes, encoding, input_path=input_path)
-        return jsonify(list(changed_files))
+        def apply_job(job):
+            all_changes, ignored_files = get_id3_changes(input_path, empty_override=False, file_patterns=patterns,
+                                                         asciify=asciify, unescape=unescape,
+                                                         folders_values=library.iter_folders_values(folder_dirs))
+            job.total = sum(len(rows) for _, rows in all_changes)
+            try:
+                return apply_changes(all_changes, encoding, input_path=input_path, index=tag_index,
+                                     errors=job.errors, progress=job.progress)
+            finally:
+                library.refresh(folder_dirs)
+
+        job = job_queue.submit('apply', apply_job)
+        return jsonify(job.to_dict()), 202
 
     @app.route("/api/apply-renames", methods=['POST'])
     def apply_renames():
@@ -112,10 +201,49 @@ def create_app(input_path):
         for folder_dir_path in folder_dir_paths:
             validate_path(folder_dir_path)
 
-        renames = get_renames(input_path, pattern, folder_dirs=folder_dirs)
-        changed_files = core_apply_renames(renames, input_path, input_path)
-
-        return jsonify(list(changed_files))
-
-
-    return app
\ No newline at end of file
+        def apply_renames_job(job):
+            renames = get_renames(input_path, pattern, folders_values=library.iter_folders_values(folder_dirs))
+            job.total = sum(len(rows) for _, rows in renames)
+            try:
+                return core_apply_renames(renames, input_path, input_path, index=tag_index,
+                                          errors=job.errors, progress=job.progress)
+            finally:
+                library.refresh(folder_dirs + [os.path.dirname(new_file_path)
+                                               for _, rows in renames for new_file_path, _ in rows])
+
+        job = job_queue.submit('apply-renames', apply_renames_job)
+        return jsonify(job.to_dict()), 202
+
+    @app.route("/api/jobs/<job_id>")
+    def job_status(job_id):
+        job = job_queue.get(job_id)
+        if job is None:
+            abort(404)
+        return jsonify(job.to_dict())
+
+    @app.route("/api/jobs/<job_id>/cancel", methods=['POST'])
+    def cancel_job(job_id):
+        job = job_queue.cancel(job_id)
+        if job is None:
+            abort(404)
+        return jsonify(job.to_dict())
+
+    @app.route("/api/stats")
+    def stats_report():
+        """
+        Collected only when UI is started with abp --profile ui.
+        """
+        return jsonify(stats.report())
+
+    return app
+
+
+def serve(app, host='127.0.0.1', port=5000, threads=8):
+    """
+    Serves app with waitress when installed, otherwise with threaded werkzeug server without debugger.
+    All threads share library model built by create_app, so library is walked once at startup.
+    """
+    if waitress is not None:
+        waitress.serve(app, host=host, port=port, threads=threads)
+    else:
+        app.run(host=host, port=port, debug=False, threaded=True)
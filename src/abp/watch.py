@@ -0,0 +1,173 @@
+"""
+Keeps library model fresh while UI is running.
+
+With inotify (inotify_simple package, Linux only) each changed directory is reported, so only it is re-read.
+Otherwise library is polled: walked comparing files modification time and size with model,
+and only changed directories are re-read.
+
+Failed refresh, e.g. when index database is locked, is logged and retried on next check.
+"""
+import os
+import errno
+import logging
+import threading
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+from abp.core import is_audio_file, scan_folder
+
+
+POLL_INTERVAL = 10  # seconds
+# Events are collected for a while, so e.g. copied album refreshes its directory once.
+INOTIFY_READ_DELAY = 500  # milliseconds
+INOTIFY_TIMEOUT = 1000  # milliseconds, how often stop is checked
+
+logger = logging.getLogger(__name__)
+
+
+class Watcher(threading.Thread):
+    def __init__(self, library):
+        super(Watcher, self).__init__()
+        self.daemon = True
+        self.library = library
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+
+class PollingWatcher(Watcher):
+    def __init__(self, library, interval=POLL_INTERVAL):
+        super(PollingWatcher, self).__init__(library)
+        self.interval = interval
+
+    def check(self):
+        changed_dirs = self.library.changed_dirs()
+        if changed_dirs:
+            self.library.refresh(changed_dirs)
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                # Model isn't changed by failed refresh, so same directories are found again on next check.
+                logger.exception('Library refresh failed, retrying in %s seconds', self.interval)
+
+
+class InotifyWatcher(Watcher):
+    """
+    Every directory of library is watched, including ones without audio files, so new sub directories are noticed.
+    Raises OSError when inotify can't be used, e.g. watches limit is too low for library.
+    """
+    def __init__(self, library):
+        super(InotifyWatcher, self).__init__(library)
+        flags = inotify_simple.flags
+        self.mask = (flags.CREATE | flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO | flags.CLOSE_WRITE |
+                     flags.ONLYDIR)
+        self.inotify = inotify_simple.INotify()
+        self.dirs = {}  # watch descriptor: dir_path
+        try:
+            self.add_watches(library.input_path)
+        except OSError:
+            self.inotify.close()
+            raise
+
+    def add_watches(self, path):
+        pending_dirs = [path]
+        while pending_dirs:
+            path = pending_dirs.pop()
+            try:
+                wd = self.inotify.add_watch(path, self.mask)
+                _, sub_dirs = scan_folder(path, stat=False)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise
+                continue  # removed in the meantime
+            self.dirs[wd] = path
+            pending_dirs.extend(sub_dirs)
+
+    def remove_watches(self, path):
+        prefix = os.path.join(path, '')
+        for wd, dir_path in list(self.dirs.items()):
+            if dir_path == path or dir_path.startswith(prefix):
+                del self.dirs[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass
+
+    def changed_dirs(self, events):
+        """
+        Output: (dir_paths, overflow), overflow means events were lost and whole library has to be checked.
+        """
+        flags = inotify_simple.flags
+        changed_dirs = set()
+        overflow = False
+
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                overflow = True
+                continue
+            dir_path = self.dirs.get(event.wd)
+            if dir_path is None:
+                continue
+            if event.mask & flags.IGNORED:
+                del self.dirs[event.wd]
+                continue
+
+            if event.mask & flags.ISDIR:
+                sub_dir = os.path.join(dir_path, event.name)
+                if event.mask & (flags.DELETE | flags.MOVED_FROM):
+                    self.remove_watches(sub_dir)
+                elif event.mask & (flags.CREATE | flags.MOVED_TO):
+                    try:
+                        self.add_watches(sub_dir)
+                    except OSError:
+                        overflow = True  # out of watches, directory is still found by walking
+                changed_dirs.add(sub_dir)
+            elif is_audio_file(event.name):
+                changed_dirs.add(dir_path)
+
+        return changed_dirs, overflow
+
+    def run(self):
+        # Failed refresh is retried with next events or after timeout.
+        failed_dirs, failed_overflow = set(), False
+        try:
+            while not self._stopped.is_set():
+                events = self.inotify.read(timeout=INOTIFY_TIMEOUT, read_delay=INOTIFY_READ_DELAY)
+                changed_dirs, overflow = self.changed_dirs(events)
+                changed_dirs.update(failed_dirs)
+                overflow = overflow or failed_overflow
+                try:
+                    if overflow:
+                        changed_dirs.update(self.library.changed_dirs())
+                    if changed_dirs:
+                        self.library.refresh([os.path.relpath(dir_path, self.library.input_path)
+                                              for dir_path in changed_dirs])
+                    failed_dirs, failed_overflow = set(), False
+                except Exception:
+                    logger.exception('Library refresh failed, retrying')
+                    failed_dirs, failed_overflow = changed_dirs, overflow
+        finally:
+            self.inotify.close()
+
+
+def start_watcher(library, poll_interval=POLL_INTERVAL):
+    """
+    Starts inotify watcher when available, polling one otherwise.
+    """
+    watcher = None
+    if inotify_simple is not None:
+        try:
+            watcher = InotifyWatcher(library)
+        except OSError:
+            pass
+    if watcher is None:
+        watcher = PollingWatcher(library, poll_interval)
+    watcher.start()
+    return watcher
@@ -1,12 +1,24 @@
 # -*- coding: utf-8 -*-
+import io
 import os
+import sys
+import json
+import struct
+import subprocess
 
+import pytest
 from click.testing import CliRunner
 from py._path.local import LocalPath
 
 from abp.__main__ import cli
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir, monkeypatch):
+    monkeypatch.setenv('ABP_CACHE_DIR', str(tmpdir / 'cache'))
+    return tmpdir / 'cache'
+
+
 def test_simple(tmpdir):
     target_id3_dir_raw = tmpdir / "id3"
     target_id3_dir = str(target_id3_dir_raw)
@@ -55,3 +67,740 @@ def test_simple(tmpdir):
     ])
     assert result.exit_code == 0
     assert (target_rename_dir_raw / 'artist name' / ' - song name - album name.mp3').isfile()
+
+
+def test_list_jobs(tmpdir):
+    target_dir_raw = tmpdir / "jobs"
+    LocalPath('tests/input').copy(target_dir_raw)
+    (target_dir_raw / 'album name' / 'broken.mp3').mksymlinkto(target_dir_raw / 'missing.mp3')
+
+    serial_result = CliRunner().invoke(cli, ['list', str(target_dir_raw)])
+    assert serial_result.exit_code == 0
+    assert 'READ ERRORS' in serial_result.output
+    assert 'broken.mp3' in serial_result.output
+
+    for executor in ('thread', 'process'):
+        result = CliRunner().invoke(cli, ['list', '--jobs', '4', '--executor', executor, str(target_dir_raw)])
+        assert result.exit_code == 0
+        assert result.output == serial_result.output
+
+
+def test_machine_readable_output(tmpdir):
+    target_dir_raw = tmpdir / "formats"
+    LocalPath('tests/input').copy(target_dir_raw)
+    target_dir = str(target_dir_raw)
+
+    result = CliRunner().invoke(cli, ['list', '--format', 'ndjson', target_dir])
+    assert result.exit_code == 0
+    assert [json.loads(line) for line in result.output.splitlines()] == [{
+        'dir': os.path.join(target_dir, 'album name'), 'file': 'artist name - song name.mp3',
+        'track_num': '', 'title': '', 'artist': '', 'album': '', 'error': None,
+    }]
+
+    result = CliRunner().invoke(cli, [
+        'id3', '--dry-run', '--format', 'csv', '-p', r'(?P<artist>[^/]+) - (?P<title>[^/]+)\.mp3$', target_dir
+    ])
+    assert result.exit_code == 0
+    assert result.output.splitlines() == [
+        'dir,file,status,track_num,title,artist,album,old_track_num,old_title,old_artist,old_album,reason',
+        os.path.join(target_dir, 'album name') + ',artist name - song name.mp3,change,,song name,artist name,,,,,,',
+    ]
+
+    result = CliRunner().invoke(cli, ['list', '--format', 'csv', target_dir])
+    assert result.output.splitlines()[1].endswith(',artist name - song name.mp3,,,,,')
+
+
+def test_stream(tmpdir):
+    target_dir_raw = tmpdir / "stream"
+    LocalPath('tests/input').copy(target_dir_raw)
+    (target_dir_raw / 'album name').copy(target_dir_raw / 'other album')
+    target_dir = str(target_dir_raw)
+
+    result = CliRunner().invoke(cli, ['id3', '--stream', '-d', '-p', r'(?P<artist>[^/]+) - (?P<title>[^/]+)\.mp3$',
+                                      target_dir], input='yn')
+    assert result.exit_code == 0
+    assert result.output.count('CHANGES') == 2  # each directory is confirmed and applied on its own
+
+    result = CliRunner().invoke(cli, ['list', '--stream', '--format', 'ndjson', target_dir])
+    assert result.exit_code == 0
+    assert [(os.path.basename(record['dir']), record['title'], record['artist'])
+            for record in map(json.loads, result.output.splitlines())] == [
+        ('album name', 'song name', 'artist name'),
+        ('other album', '', ''),
+    ]
+
+    result = CliRunner().invoke(cli, ['id3', '--stream', '--confirm-all', '-p', '(?P<title>.+)', target_dir])
+    assert result.exit_code == 2
+
+
+def test_header_reader_matches_eyed3(tmpdir):
+    from abp.benchmark import render_id3_tag, _syncsafe_bytes, MP3_FRAME
+    from abp.core import get_eyed3_id3_values, id3_deserialize, ID3_TAGS
+    from abp.readers import read_id3_tags
+
+    def id3v23_frame(frame_id, encoding, text):
+        data = encoding + text
+        return frame_id + struct.pack('>I', len(data)) + b'\x00\x00' + data
+
+    frames = (id3v23_frame(b'TIT2', b'\x01', u'Zażółć'.encode('utf16')) +
+              id3v23_frame(b'TPE1', b'\x00', u'Café'.encode('latin1')) +
+              id3v23_frame(b'TRCK', b'\x00', b'7/12'))
+    id3v23_tag = b'ID3\x03\x00\x00' + bytes(_syncsafe_bytes(len(frames) + 100)) + frames + b'\x00' * 100
+
+    def id3v1_field(text, size):
+        return text.ljust(size, b'\x00')
+
+    id3v1_tag = (b'TAG' + id3v1_field(b'v1 title', 30) + id3v1_field(b'v1 artist', 30) + id3v1_field(b'v1 album', 30) +
+                 b'2001' + id3v1_field(b'comment', 28) + b'\x00\x05' + b'\xff')
+
+    tags = {
+        'v24.mp3': render_id3_tag({'track_num': u'3/9', 'title': u'Tytuł', 'artist': u'Artist', 'album': u'Album'}) +
+        MP3_FRAME * 5,
+        'v23.mp3': id3v23_tag + MP3_FRAME * 5,
+        'v1.mp3': MP3_FRAME * 5 + id3v1_tag,
+        'none.mp3': MP3_FRAME * 5,
+    }
+    for name, data in sorted(tags.items()):
+        file_path = str(tmpdir / name)
+        with open(file_path, 'wb') as fp:
+            fp.write(data)
+        raw_tags = read_id3_tags(file_path)
+        assert [id3_deserialize(tag, raw_tags.get(tag)) for tag in ID3_TAGS] == get_eyed3_id3_values(file_path), name
+    assert get_eyed3_id3_values(str(tmpdir / 'v23.mp3')) == ['7', u'Zażółć', u'Café', '']
+    assert get_eyed3_id3_values(str(tmpdir / 'v1.mp3')) == ['5', 'v1 title', 'v1 artist', 'v1 album']
+
+
+def _vorbis_comment(comments):
+    data = struct.pack('<I', 3) + b'abp' + struct.pack('<I', len(comments))
+    for comment in comments:
+        data += struct.pack('<I', len(comment)) + comment
+    return data
+
+
+def _mp4_atom(atom_type, data):
+    return struct.pack('>I', 8 + len(data)) + atom_type + data
+
+
+def test_formats(tmpdir):
+    target_dir_raw = tmpdir / "formats"
+    LocalPath('tests/input').copy(target_dir_raw)
+    album_dir = target_dir_raw / 'album name'
+
+    comments = _vorbis_comment([b'TITLE=Flac title', b'tracknumber=2/9', b'ALBUM=album'])
+    streaminfo = b'\x00' * 34
+    (album_dir / '02 flac.flac').write_binary(
+        b'fLaC' + b'\x00' + struct.pack('>I', len(streaminfo))[1:] + streaminfo +
+        b'\x84' + struct.pack('>I', len(comments))[1:] + comments + b'\xff\xf8' * 50
+    )
+
+    def ogg_page(sequence, packet):
+        # CRC isn't checked by reader
+        return (b'OggS\x00\x00' + b'\x00' * 8 + struct.pack('<II', 1, sequence) + b'\x00' * 4 +
+                struct.pack('B', 1) + struct.pack('B', len(packet)) + packet)
+    (album_dir / '03 ogg.ogg').write_binary(
+        ogg_page(0, b'\x01vorbis' + b'\x00' * 23) +
+        ogg_page(1, b'\x03vorbis' + _vorbis_comment([b'TITLE=Ogg title', b'TRACKNUMBER=3']) + b'\x01')
+    )
+
+    items = (_mp4_atom(b'\xa9nam', _mp4_atom(b'data', struct.pack('>II', 1, 0) + b'MP4 title')) +
+             _mp4_atom(b'trkn', _mp4_atom(b'data', struct.pack('>II', 0, 0) + struct.pack('>HHHH', 0, 4, 9, 0))))
+    (album_dir / '04 mp4.m4a').write_binary(
+        _mp4_atom(b'ftyp', b'M4A \x00\x00\x00\x00') + _mp4_atom(b'mdat', b'\x00' * 100) +
+        _mp4_atom(b'moov', _mp4_atom(b'udta', _mp4_atom(b'meta', b'\x00' * 4 + _mp4_atom(b'ilst', items))))
+    )
+
+    result = CliRunner().invoke(cli, ['list', '--no-index', '--format', 'csv', str(target_dir_raw)])
+    assert result.exit_code == 0
+    assert [line.split(',', 1)[1] for line in result.output.splitlines()[1:]] == [
+        '02 flac.flac,2,Flac title,,album,',
+        '03 ogg.ogg,3,Ogg title,,,',
+        '04 mp4.m4a,4,MP4 title,,,',
+        'artist name - song name.mp3,,,,,',
+    ]
+
+    result = CliRunner().invoke(cli, ['rename', '--no-index', '-n', '--format', 'csv', '-p', '$track_num.$ext',
+                                      str(target_dir_raw)])
+    assert '02.flac' in result.output and '04.m4a' in result.output
+
+
+def test_journal_resume_undo(tmpdir, monkeypatch):
+    from abp import journal
+
+    target_dir_raw = tmpdir / "journal"
+    LocalPath('tests/input').copy(target_dir_raw)
+    (target_dir_raw / 'album name' / 'artist name - song name.mp3').copy(target_dir_raw / 'album name' / 'b - c.mp3')
+    target_dir = str(target_dir_raw)
+    journal_path = target_dir_raw / '.abp-journal'
+
+    for command in (['undo', '-f'], ['id3', '--resume'], ['rename', '--resume']):
+        result = CliRunner().invoke(cli, command + ['--no-index', target_dir])
+        assert result.exit_code != 0
+        assert 'There is no journal' in result.output
+    assert not journal_path.exists()
+
+    def titles():
+        result = CliRunner().invoke(cli, ['list', '--no-index', '--format', 'csv', target_dir])
+        return [line.split(',')[3] for line in result.output.splitlines()[1:]]
+
+    for stream in ([], ['--stream']):  # runs without changes aren't journaled, so there is nothing to resume
+        result = CliRunner().invoke(cli, ['id3', '-f', '--no-index', '-p', r'(?P<title>unmatched)\.mp3$', target_dir]
+                                    + stream)
+        assert result.exit_code == 0
+        assert journal_path.read() == ''
+    assert CliRunner().invoke(cli, ['id3', '--resume', '--no-index', target_dir]).exit_code != 0
+
+    result = CliRunner().invoke(cli, ['id3', '-f', '--no-index', '-p', r'(?P<artist>[^/]+) - (?P<title>[^/]+)\.mp3$',
+                                      target_dir])
+    assert result.exit_code == 0
+    assert titles() == ['song name', 'c']
+
+    # Interrupted run: done record of one file and end record are missing, last line is broken
+    lines = journal_path.read().splitlines()
+    journal_path.write('\n'.join(lines[:-3] + [lines[-2]]) + '\n{"op": "do')
+    result = CliRunner().invoke(cli, ['id3', '--resume', '--no-index', target_dir])
+    assert result.exit_code == 0
+    assert 'RESUMING 1 of 2 change(s)' in result.output
+    assert CliRunner().invoke(cli, ['id3', '--resume', '--no-index', target_dir]).exit_code != 0
+
+    result = CliRunner().invoke(cli, ['rename', '-f', '--no-index', '-p', '$title.$ext', target_dir])
+    assert result.exit_code == 0
+    assert sorted(os.listdir(target_dir)) == ['.abp-journal', 'album name', 'c.mp3', 'song name.mp3']
+
+    assert CliRunner().invoke(cli, ['undo', '-f', '--no-index', target_dir]).exit_code == 0
+    assert sorted(os.listdir(str(target_dir_raw / 'album name'))) == ['artist name - song name.mp3', 'b - c.mp3']
+    assert [run.kind for run in journal.read_runs(str(journal_path))] == ['id3']  # undone run and its undo dropped
+    assert CliRunner().invoke(cli, ['undo', '-f', '--no-index', target_dir]).exit_code == 0
+    assert titles() == ['', '']
+    assert journal_path.read() == ''
+    assert CliRunner().invoke(cli, ['undo', '-f', '--no-index', target_dir]).exit_code != 0
+
+    monkeypatch.setattr(journal, 'KEEP_RUNS', 2)
+    for title_size in (1, 2, 3):  # title is set to last characters of file name, so each run changes it
+        result = CliRunner().invoke(cli, ['id3', '-f', '--no-index', '-p', r'(?P<title>[^/]{%d})\.mp3$' % title_size,
+                                          target_dir])
+        assert result.exit_code == 0
+    assert titles() == ['ame', '- c']
+    assert len(journal.read_runs(str(journal_path))) == 2
+    assert CliRunner().invoke(cli, ['undo', '-f', '--no-index', target_dir]).exit_code == 0
+    assert CliRunner().invoke(cli, ['undo', '-f', '--no-index', target_dir]).exit_code == 0
+    assert titles() == ['e', 'c']  # first run was dropped from journal, so it can't be undone
+    assert CliRunner().invoke(cli, ['undo', '-f', '--no-index', target_dir]).exit_code != 0
+
+
+def test_stats_json(tmpdir):
+    target_dir_raw = tmpdir / "stats"
+    LocalPath('tests/input').copy(target_dir_raw)
+    stats_path = tmpdir / 'stats.json'
+
+    result = CliRunner().invoke(cli, ['--stats-json', str(stats_path), 'list', '--no-index', str(target_dir_raw)])
+    assert result.exit_code == 0
+    report = json.loads(stats_path.read())
+    assert report['enabled']
+    assert report['counters']['dirs_scanned'] > 0
+    assert report['counters']['files_read'] == report['phases']['read']['count'] > 0
+    assert report['counters']['bytes_read'] > 0
+    assert 'walk' in report['phases']
+
+
+def test_startup_imports():
+    """
+    Heavy dependencies are imported only on code paths which need them, not when CLI starts.
+    """
+    if sys.version_info >= (3, 7):
+        output = subprocess.check_output([sys.executable, '-X', 'importtime', '-c', 'import abp.cli'],
+                                         stderr=subprocess.STDOUT)
+        imported = [line.split('|')[-1].strip() for line in output.decode().splitlines()
+                    if line.startswith('import time:')]
+    else:
+        output = subprocess.check_output([sys.executable, '-c', 'import sys, abp.cli; print("\\n".join(sys.modules))'])
+        imported = output.decode().split()
+
+    assert 'abp.cli' in imported
+    heavy = [module for module in imported
+             if module.split('.')[0] in ('eyed3', 'unidecode', 'tabletext', 'flask', 'mutagen', 'HTMLParser')
+             or module == 'html.parser']
+    assert heavy == []
+
+
+def test_text_cache():
+    from abp.core import LRUCache, normalize_text, cached_asciify
+
+    calls = []
+    cache = LRUCache(lambda value: calls.append(value) or value.upper(), 2, 'test')
+    assert [cache(value) for value in ['a', 'b', 'a', 'c', 'b']] == ['A', 'B', 'A', 'C', 'B']
+    assert calls == ['a', 'b', 'c', 'b']  # b was least recently used when c was added
+    assert (cache.hits, cache.misses) == (1, 4)
+
+    cached_asciify.clear()
+    folder_cache = {}
+    assert normalize_text(u'Zażółć', True, True, folder_cache) == 'Zazolc'
+    assert normalize_text(u'Zażółć', True, True, folder_cache) == 'Zazolc'
+    assert normalize_text(u'Zażółć', True, True) == 'Zazolc'
+    assert (cached_asciify.hits, cached_asciify.misses) == (1, 1)
+
+
+def test_benchmark(tmpdir):
+    benchmark_dir = str(tmpdir / "benchmark")
+    result = CliRunner().invoke(cli, ['benchmark', '--folders', '3', '--files', '4', '--path', benchmark_dir])
+    assert result.exit_code == 0
+    for phase in ('get_folder_dirs', 'get_id3_values', 'get_id3_changes', 'apply_changes', 'get_renames',
+                  'apply_renames'):
+        assert phase in result.output
+    assert not os.listdir(os.path.join(benchmark_dir, 'library', 'level 0-0', 'album 0'))
+
+
+def test_pattern_set():
+    import re
+    from abp.core import PatternSet
+
+    patterns = [
+        r'^[(?P<x>]+/(?P<title>[^/]+)\.mp3$',  # group syntax inside character class is only text
+        r'(?P<artist>\w+)/(?P=artist) - (?P<title>[^/]+)\.mp3$',
+        r'(?P<album>[^/]+)/(?P<track_num>\d+)\. (?P<title>[^/]+)\.mp3$',
+        r'(?P<album>[^/]+)/(?P<title>[^/]+)\.mp3$',
+        r'(?i)LOUD/(?P<title>[^/]+)\.MP3$',
+    ]
+    paths = ['(P<x/song.mp3', 'xP/song.mp3', 'ab/song.mp3', 'abc/abc - song.mp3', 'abc/abd - song.mp3', 'album/01. song.mp3',
+             'album/song.mp3', 'loud/song.mp3', 'song.mp3', 'a/b.ogg']
+
+    def search(file_path):
+        for pattern in patterns:
+            match = re.search(pattern, file_path)
+            if match:
+                names = sorted(match.re.groupindex, key=match.re.groupindex.get)
+                return (pattern, dict((name, match.group(name)) for name in names),
+                        [(name,) + match.span(name) for name in names if match.span(name) != (-1, -1)])
+
+    pattern_set = PatternSet(patterns)
+    assert pattern_set.required_literals == ['.mp3', '.mp3', '.mp3', '.mp3', '']
+    for path in paths:
+        assert pattern_set.search(path) == search(path)
+    assert pattern_set.search('abc/abc - song.mp3')[0] == patterns[1]  # first matched pattern wins
+    assert pattern_set.search('ab/song.mp3')[0] == patterns[3]
+
+
+def test_match_rename_folders(tmpdir, monkeypatch):
+    from abp import core
+
+    target_dir_raw = tmpdir / "matched"
+    LocalPath('tests/input').copy(target_dir_raw)
+    other_dir = target_dir_raw / 'other album'
+    (target_dir_raw / 'album name').copy(other_dir)
+    (other_dir / 'artist name - song name.mp3').copy(other_dir / 'b - c.mp3')
+    target_dir = str(target_dir_raw)
+    result = CliRunner().invoke(cli, ['id3', '-f', '-p', r'album name/(?P<artist>[^/]+) - (?P<title>[^/]+)\.mp3$',
+                                      target_dir])
+    assert result.exit_code == 0
+
+    read_files = []
+    read_id3_values = core.read_id3_values
+
+    def counted_read_id3_values(file_path, *args):
+        read_files.append(os.path.basename(file_path))
+        return read_id3_values(file_path, *args)
+
+    monkeypatch.setattr(core, 'read_id3_values', counted_read_id3_values)
+    assert list(core.match_rename_folders(target_dir, '$artist/$title.$ext')) == ['album name']
+    assert len(read_files) == 2  # other album check stops at its first file, which has no tags
+    assert list(core.match_rename_folders(target_dir, '$album/$title.$ext')) == []
+    assert list(core.match_rename_folders(target_dir, '$artist/$title.$ext', folders_values=[
+        ('album name', [('artist name - song name.mp3', ['', 'song name', 'artist name', ''], None)]),
+        ('broken', [('a.mp3', None, 'IOError: broken')]),
+    ])) == ['album name']
+    monkeypatch.undo()
+
+    result = CliRunner().invoke(cli, ['rename', '-n', '--only-matched', '--format', 'csv', '-p', '$artist/$title.$ext',
+                                      target_dir])
+    assert result.exit_code == 0
+    assert [line.split(',')[:2] for line in result.output.splitlines()[1:]] == [
+        [os.path.join('album name', 'artist name - song name.mp3'), os.path.join('artist name', 'song name.mp3')],
+    ]
+
+
+def test_match_pattern_folders(tmpdir, monkeypatch):
+    from abp import core
+
+    target_dir_raw = tmpdir / "patterns"
+    LocalPath('tests/input').copy(target_dir_raw)
+    (target_dir_raw / 'album name').copy(target_dir_raw / 'other album')
+    target_dir = str(target_dir_raw)
+
+    def no_tags_read(*args, **kwargs):
+        raise AssertionError('tags are read')
+
+    monkeypatch.setattr(core, 'read_id3_values', no_tags_read)
+    monkeypatch.setattr(core, 'get_id3_values', no_tags_read)
+    patterns = [r'album name/(?P<artist>[^/]+) - (?P<title>[^/]+)\.mp3$']
+    assert list(core.match_pattern_folders(target_dir, patterns)) == ['album name']
+    assert sorted(core.match_pattern_folders(target_dir, [r'album[^/]*/(?P<title>[^/]+)\.mp3$'])) == [
+        'album name', 'other album']
+    assert list(core.match_pattern_folders(target_dir, patterns, folders=[
+        ('other album', ['artist name - song name.mp3']),
+        ('album name', ['cover.jpg', 'b - c.mp3']),
+    ])) == ['album name']
+
+
+def test_index(tmpdir, cache_dir):
+    from abp.index import open_index
+
+    target_dir_raw = tmpdir / "index"
+    LocalPath('tests/input').copy(target_dir_raw)
+    result = CliRunner().invoke(cli, ['list', str(target_dir_raw)])
+    assert result.exit_code == 0
+    assert sorted(os.listdir(str(target_dir_raw))) == ['album name']  # library isn't written by list
+    assert len(cache_dir.listdir()) == 1
+
+    song = target_dir_raw / 'album name' / 'song.mp3'
+    song.write_binary(b'\x00' * 10)
+    index = open_index(str(target_dir_raw))
+    stat = os.stat(str(song))
+    assert index.get(str(song), stat) is None
+    index.set(str(song), stat, {'title': 'song'})
+    assert index.get(str(song), stat) == {'title': 'song'}
+
+    song.write_binary(b'\x00' * 11)
+    assert index.get(str(song), os.stat(str(song))) is None  # size changed
+    song.write_binary(b'\x00' * 10)
+    os.utime(str(song), (stat.st_atime, stat.st_mtime + 10))
+    assert index.get(str(song), os.stat(str(song))) is None  # mtime changed
+    index.set(str(song), os.stat(str(song)), {'title': 'song'})
+
+    song.remove()
+    assert index.prune() == 0  # pruned when opened, next check is due tomorrow
+    assert index.prune(every=0) == 1
+    index.close()
+    assert open_index(str(target_dir_raw)).prune(every=0) == 0
+
+
+def test_move_across_filesystems(tmpdir, monkeypatch):
+    import errno
+    from abp import moves
+
+    rename = os.rename
+
+    def cross_device_rename(src, dst):
+        if not src.endswith(moves.TMP_FILE_SUFFIX):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        rename(src, dst)
+
+    monkeypatch.setattr(os, 'rename', cross_device_rename)
+    src = tmpdir / 'src.mp3'
+    src.write_binary(b'data' * 1000)
+    (tmpdir / 'out').mkdir()
+    assert moves.move_file(str(src), str(tmpdir / 'out' / 'dst.mp3'))
+    assert (tmpdir / 'out' / 'dst.mp3').read_binary() == b'data' * 1000
+    assert not src.exists()
+    assert os.listdir(str(tmpdir / 'out')) == ['dst.mp3']
+
+    def failing_copy(src_fd, dst_fd, size):
+        os.write(dst_fd, b'da')
+        raise IOError('No space left on device')
+
+    def corrupting_copy(src_fd, dst_fd, size):
+        os.write(dst_fd, b'x' * size)
+        return True
+
+    for fast_copy in (failing_copy, corrupting_copy):
+        monkeypatch.setattr(moves, '_fast_copy', fast_copy)
+        src.write_binary(b'data' * 1000)
+        with pytest.raises(IOError):
+            moves.move_file(str(src), str(tmpdir / 'out' / 'other.mp3'))
+        assert src.read_binary() == b'data' * 1000
+        assert os.listdir(str(tmpdir / 'out')) == ['dst.mp3']
+
+    # second move to same target starting while first one is copying
+    copy_file = moves.copy_file
+    other = tmpdir / 'other.mp3'
+    other.write_binary(b'atad' * 1000)
+    src.write_binary(b'data' * 1000)
+
+    def interleaved_copy(copy_src, copy_dst):
+        copy_file(copy_src, copy_dst)
+        if copy_src == str(src):
+            moves.move_file(str(other), str(tmpdir / 'out' / 'dst.mp3'))
+
+    monkeypatch.undo()
+    monkeypatch.setattr(os, 'rename', cross_device_rename)
+    monkeypatch.setattr(moves, 'copy_file', interleaved_copy)
+    moves.move_file(str(src), str(tmpdir / 'out' / 'dst.mp3'))
+    assert (tmpdir / 'out' / 'dst.mp3').read_binary() == b'data' * 1000
+    assert not src.exists() and not other.exists()
+    assert os.listdir(str(tmpdir / 'out')) == ['dst.mp3']
+
+
+def test_ui_id3_list(tmpdir):
+    from abp.ui import create_app
+
+    target_dir_raw = tmpdir / "ui"
+    LocalPath('tests/input').copy(target_dir_raw)
+    album_dir = target_dir_raw / 'album name'
+    for name in ('a.mp3', 'b.mp3', 'c.mp3'):
+        (album_dir / 'artist name - song name.mp3').copy(album_dir / name)
+    app = create_app(str(target_dir_raw), watch=False)
+    client = app.test_client()
+
+    assert client.get('/api/id3-list').status_code == 400
+    for limit in (-1, 0):
+        assert client.get('/api/id3-list', query_string={'path': 'album name', 'limit': limit}).status_code == 400
+
+    files = []
+    query = {'path': 'album name', 'limit': 2, 'fields': 'file'}
+    while True:
+        response = client.get('/api/id3-list', query_string=query)
+        assert response.status_code == 200
+        assert all(list(item) == ['file'] for item in response.get_json())
+        files.extend(item['file'] for item in response.get_json())
+        if 'X-Next-Cursor' not in response.headers:
+            break
+        query['cursor'] = response.headers['X-Next-Cursor']
+    assert files == [os.path.join('album name', name)
+                     for name in ('a.mp3', 'artist name - song name.mp3', 'b.mp3', 'c.mp3')]
+
+    response = client.get('/api/id3-list', query_string={'path': 'album name'})
+    etag = response.headers['ETag']
+    assert response.get_json()[0] == {'file': os.path.join('album name', 'a.mp3'),
+                                      'id3': {'track_num': '', 'title': '', 'artist': '', 'album': ''}}
+    response = client.get('/api/id3-list', query_string={'path': 'album name'}, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    with open(str(album_dir / 'b.mp3'), 'ab') as fp:
+        fp.write(b'\x00' * 10)
+    app.library.refresh(['album name'])
+    response = client.get('/api/id3-list', query_string={'path': 'album name'}, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_ui_serve(tmpdir, monkeypatch):
+    import gzip
+    from abp import ui
+
+    target_dir_raw = tmpdir / "ui"
+    LocalPath('tests/input').copy(target_dir_raw)
+    album_dir = target_dir_raw / 'album name'
+    for i in range(20):
+        (album_dir / 'artist name - song name.mp3').copy(album_dir / ('%02d.mp3' % i))
+    app = ui.create_app(str(target_dir_raw), watch=False)
+    client = app.test_client()
+
+    query = {'path': 'album name'}
+    plain = client.get('/api/id3-list', query_string=query)
+    assert 'Content-Encoding' not in plain.headers
+    assert len(plain.data) >= ui.GZIP_MIN_SIZE
+    compressed = client.get('/api/id3-list', query_string=query, headers={'Accept-Encoding': 'gzip, deflate'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in compressed.headers['Vary']
+    assert len(compressed.data) < len(plain.data)
+    assert gzip.GzipFile(fileobj=io.BytesIO(compressed.data)).read() == plain.data
+    small = client.get('/api/id3-list', query_string=dict(query, limit=1), headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in small.headers
+
+    served = []
+
+    class Waitress(object):
+        @staticmethod
+        def serve(app, **kwargs):
+            served.append(('waitress', kwargs))
+
+    monkeypatch.setattr(ui, 'waitress', Waitress)
+    monkeypatch.setattr(app, 'run', lambda **kwargs: served.append(('werkzeug', kwargs)))
+    ui.serve(app, port=8000, threads=4)
+    monkeypatch.setattr(ui, 'waitress', None)
+    ui.serve(app, port=8000, threads=4)
+    assert served == [
+        ('waitress', {'host': '127.0.0.1', 'port': 8000, 'threads': 4}),
+        ('werkzeug', {'host': '127.0.0.1', 'port': 8000, 'debug': False, 'threaded': True}),
+    ]
+
+
+def test_jobs(tmpdir):
+    import threading
+    from abp.jobs import JobQueue, DONE, FAILED, CANCELLED
+    from abp.ui import create_app
+
+    queue = JobQueue()
+
+    def apply_job(job, files):
+        job.total = len(files)
+        for file_name in files:
+            if file_name.startswith('bad'):
+                job.errors.append((file_name, 'unreadable'))
+            job.progress(file_name)
+        return len(files) - len(job.errors)
+
+    job = queue.submit('apply', apply_job, ['a', 'bad', 'c'])
+    queue.executor.submit(lambda: None).result()  # jobs run in order, so job has finished
+    assert queue.get(job.id) is job
+    status = job.to_dict()
+    assert (status['status'], status['total'], status['done'], status['result']) == (DONE, 3, 3, 2)
+    assert status['errors'] == [('bad', 'unreadable')]
+
+    failed = queue.submit('fail', lambda job: 1 / 0)
+    queue.executor.submit(lambda: None).result()
+    assert failed.status == FAILED and failed.error.startswith('ZeroDivisionError')
+
+    started = threading.Event()
+
+    def endless_job(job):
+        while True:
+            started.set()
+            job.progress()
+
+    running = queue.submit('endless', endless_job)
+    started.wait(5)
+    queue.cancel(running.id)
+    queue.executor.submit(lambda: None).result()
+    assert running.status == CANCELLED and running.done > 0
+    assert queue.cancel('unknown') is None and queue.get('unknown') is None
+    queue.shutdown()
+
+    target_dir_raw = tmpdir / "jobs"
+    LocalPath('tests/input').copy(target_dir_raw)
+    app = create_app(str(target_dir_raw), watch=False)
+    client = app.test_client()
+    response = client.post('/api/apply', data={
+        'patterns': r'(?P<artist>[^/]+) - (?P<title>[^/]+)\.mp3$', 'encoding': 'utf8', 'folder-path': 'album name'
+    })
+    assert response.status_code == 202
+    job_id = response.get_json()['id']
+    app.job_queue.executor.submit(lambda: None).result()
+    status = client.get('/api/jobs/%s' % job_id).get_json()
+    assert (status['status'], status['total'], status['done'], status['errors']) == (DONE, 1, 1, [])
+    assert client.post('/api/jobs/%s/cancel' % job_id).get_json()['status'] == DONE
+    assert client.get('/api/jobs/unknown').status_code == 404
+    assert client.post('/api/jobs/unknown/cancel').status_code == 404
+
+
+def test_padded_tag(tmpdir):
+    from abp.core import write_id3_tags, get_id3_values, TAG_PADDING
+
+    song = tmpdir / 'song.mp3'
+    LocalPath('tests/input/album name/artist name - song name.mp3').copy(song)
+
+    def tag_size():
+        header = song.read_binary()[:10]
+        assert header[:3] == b'ID3'
+        return sum((byte & 0x7f) << (7 * (3 - i)) for i, byte in enumerate(bytearray(header[6:10])))
+
+    assert write_id3_tags(str(song), ['1', 'title', 'artist', 'album'])  # file without tag is rewritten
+    assert tag_size() >= TAG_PADDING
+    file_size = song.size()
+
+    assert not write_id3_tags(str(song), ['2', 'much longer title ' * 10, 'artist', 'album'])
+    assert song.size() == file_size
+    assert get_id3_values(str(song))[:2] == ['2', 'much longer title ' * 10]
+
+
+def test_since_checkpoint(tmpdir):
+    target_dir_raw = tmpdir / "since"
+    LocalPath('tests/input').copy(target_dir_raw)
+    album_dir = target_dir_raw / 'album name'
+    (album_dir / 'artist name - song name.mp3').copy(album_dir / 'b - c.mp3')
+    checkpoint = str(tmpdir / 'checkpoint')
+
+    def renamed_files():
+        result = CliRunner().invoke(cli, ['rename', '-n', '--format', 'csv', '--since', checkpoint, '-p', '$title.$ext',
+                                          str(target_dir_raw)])
+        assert result.exit_code == 0
+        return [line.split(',')[1] for line in result.output.splitlines()[1:]]
+
+    id3_args = ['id3', '--since', checkpoint, '-p', r'(?P<artist>[^/]+) - (?P<title>[^/]+)\.mp3$', str(target_dir_raw)]
+    result = CliRunner().invoke(cli, id3_args, input='yn')
+    assert result.exit_code == 0
+    assert not os.path.exists(checkpoint)  # declined change is still pending
+
+    result = CliRunner().invoke(cli, id3_args + ['-f'])
+    assert result.exit_code == 0
+    assert os.path.exists(checkpoint)
+    assert renamed_files() == []  # files written by id3 run are skipped, though modified after its start
+
+    with open(str(album_dir / 'b - c.mp3'), 'ab') as fp:
+        fp.write(b'\x00')
+    assert renamed_files() == ['c.mp3']
+
+
+def test_polling_watcher(tmpdir, monkeypatch):
+    import time
+    import sqlite3
+    from abp.library import Library
+    from abp.watch import PollingWatcher
+
+    target_dir_raw = tmpdir / "watch"
+    LocalPath('tests/input').copy(target_dir_raw)
+    library = Library(str(target_dir_raw))
+    library.load()
+    watcher = PollingWatcher(library, interval=0.01)
+    assert library.folder_dirs() == ['album name']
+
+    (target_dir_raw / 'album name').move(target_dir_raw / 'new album')
+    watcher.check()
+    assert library.folder_dirs() == ['new album']
+
+    calls = []
+    refresh = library.refresh
+
+    def locked_refresh(dir_paths):
+        calls.append(dir_paths)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        refresh(dir_paths)
+
+    monkeypatch.setattr(library, 'refresh', locked_refresh)
+    (target_dir_raw / 'new album').copy(target_dir_raw / 'other album')
+    watcher.start()
+    deadline = time.time() + 5
+    while library.folder_dirs() != ['new album', 'other album'] and time.time() < deadline:
+        time.sleep(0.01)
+    watcher.stop()
+    watcher.join()
+    assert library.folder_dirs() == ['new album', 'other album']  # failed refresh was retried
+    assert len(calls) >= 2
+
+
+def test_index_concurrent_writers(tmpdir, monkeypatch):
+    import threading
+    from abp import index as index_module
+    from abp.core import apply_changes
+
+    monkeypatch.setattr(index_module, 'LOCK_TIMEOUT', 0.1)
+    target_dir_raw = tmpdir / "concurrent"
+    LocalPath('tests/input').copy(target_dir_raw)
+    song = str(target_dir_raw / 'album name' / 'artist name - song name.mp3')
+    index = index_module.open_index(str(target_dir_raw))
+    assert index._connection().execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+    def apply_job():  # e.g. UI job worker, its connection is kept open afterwards
+        apply_changes([(os.path.dirname(song), [(os.path.basename(song), ['1', 'title', '', ''], [''] * 4)])], 'utf8',
+                      index=index)
+    worker = threading.Thread(target=apply_job)
+    worker.start()
+    worker.join()
+
+    # e.g. UI watcher refreshing library, it would fail with "database is locked" if job kept rows uncommitted
+    index.set(song, os.stat(song), ['1', 'other', '', ''])
+    index.commit()
+    assert index.get(song, os.stat(song)) == ['1', 'other', '', '']
+
+
+def test_write_reads_once(tmpdir):
+    from abp.core import get_id3_values
+    from abp.index import open_index
+
+    target_dir_raw = tmpdir / "write"
+    LocalPath('tests/input').copy(target_dir_raw)
+    album_dir = target_dir_raw / 'album name'
+    (album_dir / 'artist name - song name.mp3').move(album_dir / '01 a - b.mp3')
+    (album_dir / '01 a - b.mp3').copy(album_dir / '02 c - d.mp3')
+    stats_path = tmpdir / 'stats.json'
+
+    result = CliRunner().invoke(cli, ['--stats-json', str(stats_path), 'id3', '-f', '-p',
+                                      r'(?P<track_num>\d+) (?P<artist>[^/]+) - (?P<title>[^/]+)\.mp3$',
+                                      str(target_dir_raw)])
+    assert result.exit_code == 0
+    counters = json.loads(stats_path.read())['counters']
+    assert counters['files_read'] == counters['files_written'] == 2
+
+    index = open_index(str(target_dir_raw))
+    for song in album_dir.listdir():
+        assert index.get(str(song), os.stat(str(song))) == get_id3_values(str(song))
+    assert get_id3_values(str(album_dir / '01 a - b.mp3')) == ['1', 'b', 'a', '']